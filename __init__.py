@@ -1,28 +1,50 @@
 """
 Priority Reorder Addon - Main entry point.
+
+Only registers the menu action, sync hooks and note added hook. The config, the reorder modules and
+the dictionaries are loaded when they are first needed.
 """
 
 from aqt import mw
-from aqt.utils import showInfo, qconnect
+from aqt.utils import qconnect
 from aqt.qt import QAction, QKeySequence
 from aqt import gui_hooks
-from aqt.operations import CollectionOp
 
-from . import config
-from . import cards
-from .log import *
+from .scheduler import scheduler
 
 def run_in_background():
     """Run the reordering operation in the background"""
-    operation = CollectionOp(parent=mw, op=cards.reorder_cards_with_priority_queue_manual).failure(
-        lambda err: showInfo(f"Error during reordering: {err}")
-    )
-    operation.run_in_background()
+    scheduler.request_manual()
+
+def on_sync_will_start():
+    """Load the dictionaries used in the searches in the background while syncing, ahead of the reorder after it"""
+    from .config import get_current_config
+    config = get_current_config()
+    if config.reorder_before_sync:
+        from .dictionaries import dictionary_manager
+        from .plan import get_reorder_plan
+        dictionary_manager.prewarm(list(get_reorder_plan(config).dictionaries))
+
+def on_sync_did_finish():
+    """Reorder after sync if enabled in config"""
+    from .config import get_current_config
+    if get_current_config().reorder_before_sync:
+        scheduler.request_sync_finish()
+
+def on_note_added(note):
+    """Place the cards of a note added in the Add window, if enabled in config"""
+    from .config import get_current_config
+    if get_current_config().place_added_cards:
+        scheduler.request_placement()
+
+def setup_sync_hooks():
+    """Set up sync hooks, which check the config when they run"""
+    gui_hooks.sync_will_start.append(on_sync_will_start)
+    gui_hooks.sync_did_finish.append(on_sync_did_finish)
 
-def setup_sync_hook():
-    """Set up sync hook if enabled in config"""
-    if config.get_current_config().reorder_before_sync:
-        gui_hooks.sync_did_finish.append(lambda: cards.reorder_cards_with_priority_queue_sync_finish())
+def setup_add_hook():
+    """Set up placing added cards, which checks the config when it runs"""
+    gui_hooks.add_cards_did_add_note.append(on_note_added)
 
 def setup_menu():
     """Set up menu entries and shortcuts"""
@@ -32,7 +54,6 @@ def setup_menu():
     mw.form.menuTools.addAction(action)
 
 # Initialize the addon
-log(CRITICAL, "***********************************************************************")
-config.reload_config()
-setup_sync_hook()
-setup_menu()
\ No newline at end of file
+setup_sync_hooks()
+setup_add_hook()
+setup_menu()
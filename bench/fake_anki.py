@@ -0,0 +1,297 @@
+"""
+Headless stand-ins for the parts of aqt and anki the addon uses, backed by an
+in-memory SQLite database with the columns of Anki's cards and notes tables.
+
+Only the search syntax used by the benchmark scenarios is understood: space
+separated terms of deck:, tag:, added:, nid:, cid:, is:new and Field:*, each
+optionally negated with a leading "-".
+"""
+
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from typing import Any, Dict, List
+
+FIELD_SEPARATOR = "\x1f"
+DAY_MS = 86400 * 1000
+
+def ids2str(ids) -> str:
+    return "(" + ",".join(str(int(i)) for i in ids) + ")"
+
+class OpChanges:
+    pass
+
+class OpChangesAfterUndo:
+    def __init__(self, changes: OpChanges) -> None:
+        self.changes = changes
+
+class OpChangesWithCount:
+    def __init__(self, count: int = 0, changes: OpChanges | None = None) -> None:
+        self.count = count
+        self.changes = changes
+
+class FakeDB:
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.query_count = 0
+
+    def all(self, sql: str, *args) -> List[tuple]:
+        self.query_count += 1
+        return self.conn.execute(sql, args).fetchall()
+
+    def list(self, sql: str, *args) -> List[Any]:
+        return [row[0] for row in self.all(sql, *args)]
+
+    def scalar(self, sql: str, *args) -> Any:
+        row = self.first(sql, *args)
+        return row[0] if row else None
+
+    def first(self, sql: str, *args) -> tuple | None:
+        rows = self.all(sql, *args)
+        return rows[0] if rows else None
+
+    def execute(self, sql: str, *args) -> None:
+        self.query_count += 1
+        self.conn.execute(sql, args)
+
+class FakeModels:
+    def __init__(self) -> None:
+        self.models: Dict[int, Dict[str, Any]] = {}
+
+    def get(self, mid: int) -> Dict[str, Any] | None:
+        return self.models.get(mid)
+
+    def field_map(self, model: Dict[str, Any]) -> Dict[str, tuple]:
+        return {field["name"]: (field["ord"], field) for field in model["flds"]}
+
+class FakeNote:
+    def __init__(self, col: "FakeCollection", note_id: int) -> None:
+        self.id = note_id
+        self.mid, flds, self.mod = col.db.first("select mid, flds, mod from notes where id = ?", note_id)
+        self._field_map = col.models.field_map(col.models.get(self.mid))
+        self.fields = flds.split(FIELD_SEPARATOR)
+
+    def __contains__(self, field_name: str) -> bool:
+        return field_name in self._field_map
+
+    def __getitem__(self, field_name: str) -> str:
+        return self.fields[self._field_map[field_name][0]]
+
+class FakeCard:
+    def __init__(self, col: "FakeCollection", card_id: int) -> None:
+        self.col = col
+        self.id = card_id
+        self.nid = col.db.scalar("select nid from cards where id = ?", card_id)
+
+    def note(self) -> FakeNote:
+        return FakeNote(self.col, self.nid)
+
+class FakeScheduler:
+    def __init__(self, col: "FakeCollection") -> None:
+        self.col = col
+        self.today = 0
+
+    def reposition_new_cards(self, card_ids, starting_from: int, step_size: int, randomize: bool, shift_existing: bool) -> OpChangesWithCount:
+        card_ids = list(card_ids)
+        db = self.col.db
+        self.col._remember_dues(card_ids)
+        # Like Anki, every card written gets the current mod time and a usn of -1 until the next sync
+        mod = int(time.time())
+        if shift_existing:
+            db.execute(
+                f"update cards set due = due + ?, mod = ?, usn = -1 where type = 0 and due >= ? and id not in {ids2str(card_ids)}",
+                step_size * len(card_ids), mod, starting_from,
+            )
+        db.conn.executemany(
+            "update cards set due = ?, mod = ?, usn = -1 where id = ?",
+            [(starting_from + i * step_size, mod, card_id) for i, card_id in enumerate(card_ids)],
+        )
+        self.col.cards_written += len(card_ids)
+        return OpChangesWithCount(count=len(card_ids))
+
+class FakeDecks:
+    def __init__(self, col: "FakeCollection") -> None:
+        self.col = col
+
+    def get(self, deck_id: int, default: bool = True) -> Dict[str, Any] | None:
+        row = self.col.db.first("select id, name, dyn from decks where id = ?", deck_id)
+        return {"id": row[0], "name": row[1], "dyn": row[2]} if row else None
+
+    def config_dict_for_deck_id(self, deck_id: int) -> Dict[str, Any]:
+        # Like Anki, a filtered deck's "config" is the deck itself
+        if self.get(deck_id)["dyn"]:
+            return self.get(deck_id)
+        return {"new": {"perDay": 20}}
+
+    def all_config(self) -> List[Dict[str, Any]]:
+        return [{"id": 1, "mod": 0, "new": {"perDay": 20}}]
+
+class FakeCollection:
+    def __init__(self, path: str) -> None:
+        conn = sqlite3.connect(":memory:")
+        # Cards and notes start with a usn of 0, as in a collection that was just synced
+        conn.executescript("""
+            create table cards (id integer primary key, nid integer, did integer, ord integer, mod integer, type integer, queue integer, due integer, usn integer default 0, odid integer default 0);
+            create index ix_cards_nid on cards (nid);
+            create table notes (id integer primary key, mid integer, mod integer, tags text, flds text, usn integer default 0);
+            create table decks (id integer primary key, name text, dyn integer default 0);
+            create table col (scm integer, mod integer);
+            insert into col values (1, 1);
+        """)
+        self.path = path
+        self.db = FakeDB(conn)
+        self.models = FakeModels()
+        self.decks = FakeDecks(self)
+        self.sched = FakeScheduler(self)
+        self.search_count = 0
+        self.cards_written = 0
+        self._undo_entries = 0
+        # Previous due of every card repositioned since the last custom undo entry
+        self._undo_dues: Dict[int, int] = {}
+
+    def _term_sql(self, term: str) -> str:
+        negated = term.startswith("-")
+        term = term[1:] if negated else term
+        key, _, value = term.partition(":")
+        value = value.strip('"')
+        if term == "is:new":
+            sql = "c.type = 0"
+        elif key == "deck":
+            sql = f"c.did in (select id from decks where name = '{value}' or name like '{value}::%')"
+        elif key == "tag":
+            sql = f"(' ' || n.tags || ' ') like '% {value} %'"
+        elif key == "added":
+            sql = f"c.id > {int(time.time() * 1000) - int(value) * DAY_MS}"
+        elif key in ("nid", "cid"):
+            sql = f"{'n' if key == 'nid' else 'c'}.id in ({value})"
+        elif value == "*":
+            mids = [mid for mid, model in self.models.models.items() if key in self.models.field_map(model)]
+            sql = f"n.mid in {ids2str(mids)}"
+        else:
+            raise ValueError(f"Unsupported search term in benchmark collection: {term}")
+        return f"not ({sql})" if negated else sql
+
+    def _where(self, query: str) -> str:
+        # Searches here only join terms with "and", so grouping doesn't change them
+        return " and ".join(self._term_sql(term) for term in query.replace("(", " ").replace(")", " ").split()) or "1"
+
+    def find_cards(self, query: str, order: str | bool = False) -> List[int]:
+        self.search_count += 1
+        sql = f"select c.id from cards c join notes n on c.nid = n.id where {self._where(query)}"
+        if isinstance(order, str) and order:
+            sql += f" order by {order}"
+        return self.db.list(sql)
+
+    def find_notes(self, query: str) -> List[int]:
+        self.search_count += 1
+        return self.db.list(f"select distinct n.id from cards c join notes n on c.nid = n.id where {self._where(query)}")
+
+    def get_card(self, card_id: int) -> FakeCard:
+        return FakeCard(self, card_id)
+
+    def get_note(self, note_id: int) -> FakeNote:
+        return FakeNote(self, note_id)
+
+    def _remember_dues(self, card_ids: List[int]) -> None:
+        for card_id, due in self.db.conn.execute(f"select id, due from cards where id in {ids2str(card_ids)}"):
+            self._undo_dues.setdefault(card_id, due)
+
+    def add_custom_undo_entry(self, name: str) -> int:
+        self._undo_entries += 1
+        self._undo_dues = {}
+        return self._undo_entries
+
+    def merge_undo_entries(self, target: int) -> OpChanges:
+        return OpChanges()
+
+    def undo(self) -> OpChangesAfterUndo:
+        """Restores the cards repositioned since the last custom undo entry, without shifted ones."""
+        self.db.conn.executemany("update cards set due = ? where id = ?", [(due, card_id) for card_id, due in self._undo_dues.items()])
+        self._undo_dues = {}
+        return OpChangesAfterUndo(OpChanges())
+
+def build_collection(card_count: int, seed: int = 0, vocabulary_size: int = 20000) -> FakeCollection:
+    """A mining deck of card_count new cards, one card per note, added over the last 60 days."""
+    rng = random.Random(seed)
+    col = FakeCollection(os.path.join(tempfile.mkdtemp(prefix="priority-reorder-bench-"), "collection.anki2"))
+    col.models.models[1] = {"id": 1, "name": "Lapis", "flds": [
+        {"name": name, "ord": ord} for ord, name in enumerate(["Expression", "ExpressionReading", "FreqSort"])
+    ]}
+    col.models.models[2] = {"id": 2, "name": "Basic", "flds": [{"name": "Front", "ord": 0}, {"name": "Back", "ord": 1}]}
+    col.db.conn.executemany("insert into decks (id, name) values (?, ?)", [(1, "Mining"), (2, "Other")])
+
+    now = int(time.time() * 1000)
+    step = max(60 * DAY_MS // max(card_count, 1), 1)
+    notes, cards = [], []
+    for i in range(card_count):
+        note_id = now - (card_count - i) * step
+        if i % 40 == 0:
+            notes.append((note_id, 2, note_id // 1000, "", f"front{i}{FIELD_SEPARATOR}back"))
+        else:
+            word = rng.randrange(vocabulary_size)
+            freq = "" if i % 97 == 0 else str(rng.randint(1, 60000))
+            tags = "anime" if rng.random() < 0.2 else ""
+            notes.append((note_id, 1, note_id // 1000, tags, FIELD_SEPARATOR.join([f"w{word}", f"r{word}", freq])))
+        cards.append((note_id, note_id, 1 if i % 10 else 2, 0, 0, 0, 0, rng.randrange(card_count)))
+    col.db.conn.executemany("insert into notes (id, mid, mod, tags, flds) values (?, ?, ?, ?, ?)", notes)
+    col.db.conn.executemany("insert into cards (id, nid, did, ord, mod, type, queue, due) values (?, ?, ?, ?, ?, ?, ?, ?)", cards)
+    return col
+
+def write_term_meta_bank(dict_dir: str, entry_count: int, seed: int = 0, vocabulary_size: int = 20000, banks: int = 1) -> List[str]:
+    """Writes a Yomitan occurrence dictionary over the words used by build_collection."""
+    rng = random.Random(seed)
+    os.makedirs(dict_dir, exist_ok=True)
+    entries = []
+    for i in range(entry_count):
+        word = i % vocabulary_size
+        count = rng.randint(1, 400)
+        if i % 3 == 0:
+            entries.append([f"w{word}", "freq", {"reading": f"r{word}", "frequency": {"value": count, "displayValue": str(count)}}])
+        else:
+            entries.append([f"w{word}", "freq", {"value": count}])
+    paths = []
+    per_bank = -(-len(entries) // banks)
+    for bank in range(banks):
+        path = os.path.join(dict_dir, f"term_meta_bank_{bank + 1}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entries[bank * per_bank:(bank + 1) * per_bank], f, ensure_ascii=False)
+        paths.append(path)
+    return paths
+
+class FakeAction:
+    def __init__(self, text: str, parent: Any) -> None:
+        self.text = text
+        self.triggered = None
+
+    def setShortcut(self, shortcut: str) -> None:
+        self.shortcut = shortcut
+
+def install_fake_anki(col: FakeCollection, config: Dict[str, Any]) -> types.SimpleNamespace:
+    """Registers fake aqt and anki modules so the addon modules import without Qt."""
+    mw = types.SimpleNamespace(col=col)
+    mw.progress = types.SimpleNamespace(update=lambda **kwargs: None, want_cancel=lambda: False)
+    mw.taskman = types.SimpleNamespace(run_on_main=lambda closure: closure())
+    mw.addonManager = types.SimpleNamespace(getConfig=lambda name: config)
+    mw.form = types.SimpleNamespace(menuTools=types.SimpleNamespace(addAction=lambda action: None))
+
+    def module(name: str, **attrs) -> types.ModuleType:
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    aqt = module("aqt", mw=mw)
+    aqt.gui_hooks = module("aqt.gui_hooks", sync_will_start=[], sync_did_finish=[], add_cards_did_add_note=[])
+    module("aqt.operations", CollectionOp=None)
+    module("aqt.qt", QAction=FakeAction, QKeySequence=str, QTimer=None)
+    module("aqt.utils", qconnect=lambda signal, slot: None, showInfo=print)
+    module("anki")
+    module("anki.collection", Collection=FakeCollection, OpChanges=OpChanges, OpChangesWithCount=OpChangesWithCount)
+    module("anki.notes", Note=FakeNote)
+    module("anki.utils", ids2str=ids2str)
+    return mw
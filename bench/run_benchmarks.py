@@ -0,0 +1,273 @@
+"""
+Times the reorder pipeline headlessly over synthetic collections.
+
+    python bench/run_benchmarks.py --sizes 1000 10000 --output bench_results.json
+    python bench/run_benchmarks.py --compare previous.json --output bench_results.json
+    python bench/run_benchmarks.py --sizes --max-import-ms 50
+
+Each scenario builds a fresh synthetic collection, runs a full reorder, a
+second no-change reorder and a no-change reorder triggered by sync, and
+records wall time per stage. Stage times are
+cumulative over every call of the named addon function during the run.
+
+The time Anki spends importing the addon at startup is measured first, in a
+fresh interpreter, along with the addon modules that import loads.
+"""
+
+import argparse
+import functools
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import types
+from typing import Any, Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+PACKAGE_NAME = "priority_reorder"
+BENCH_DICTIONARY = "__bench_occurrences"
+
+sys.path.insert(0, BENCH_DIR)
+import fake_anki
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+
+BASE_CONFIG: Dict[str, Any] = {
+    "priority_search": ["deck:Mining added:3"],
+    "priority_search_mode": "sequential",
+    "normal_search": "deck:Mining -added:3",
+    "sort_field": "FreqSort",
+    "sort_reverse": False,
+    "priority_cutoff": None,
+    "normal_prioritization": None,
+    "priority_limit": None,
+    "shift_existing": True,
+    "reorder_before_sync": True,
+    "search_fields": {
+        "expression_field": "Expression",
+        "expression_reading_field": "ExpressionReading",
+    },
+}
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "recent": {},
+    "sequential_rules": {
+        "priority_search": ["deck:Mining added:3", "deck:Mining tag:anime", "deck:Mining added:14"],
+        "normal_search": "deck:Mining",
+        "priority_cutoff": 30000,
+        "normal_prioritization": 500,
+        "priority_limit": 200,
+    },
+    "incremental": {
+        "priority_search": ["deck:Mining added:3", "deck:Mining tag:anime", "deck:Mining added:14"],
+        "normal_search": "deck:Mining",
+        "priority_cutoff": 30000,
+        "normal_prioritization": 500,
+        "priority_limit": 200,
+        "incremental_reorder": True,
+    },
+    "occurrences": {
+        "priority_search": [f"deck:Mining occurrences:{BENCH_DICTIONARY}>=200"],
+        "normal_search": f"deck:Mining occurrences:{BENCH_DICTIONARY}<200",
+    },
+    "occurrences_cached": {
+        "priority_search": [f"deck:Mining occurrences:{BENCH_DICTIONARY}>=200"],
+        "normal_search": f"deck:Mining occurrences:{BENCH_DICTIONARY}<200",
+        "cache_occurrence_counts": True,
+    },
+}
+
+# (stage name, module, function) timed whenever the function exists in the tree under test.
+# Finer phases and counters come from the addon's own metrics module.
+STAGES = [
+    ("classify", "cards", "classify_cards"),
+    ("search", "cards", "get_cards_from_search"),
+    ("rules", "cards", "apply_cutoff_and_prioritization_rules"),
+    ("priority_sort", "cards", "apply_priority_limit"),
+    ("sort", "cards", "select_top_card_tuples"),
+    ("reposition", "cards", "reposition_new_cards"),
+]
+
+def load_addon(mw_config: Dict[str, Any]) -> types.SimpleNamespace:
+    mw = fake_anki.install_fake_anki(None, mw_config)
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [ADDON_DIR]
+    sys.modules[PACKAGE_NAME] = package
+    return mw
+
+def _timed(stage_times: Dict[str, float], stage: str, func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[stage] = stage_times.get(stage, 0.0) + time.perf_counter() - start
+    return wrapper
+
+def instrument(stage_times: Dict[str, float]) -> List[tuple]:
+    patched = []
+    for stage, module_name, attr_path in STAGES:
+        target = sys.modules.get(f"{PACKAGE_NAME}.{module_name}")
+        *owners, attr = attr_path.split(".")
+        for owner in owners:
+            target = getattr(target, owner, None)
+        if target is None or not hasattr(target, attr):
+            continue
+        original = getattr(target, attr)
+        setattr(target, attr, _timed(stage_times, stage, original))
+        patched.append((target, attr, original))
+    return patched
+
+def restore(patched: List[tuple]) -> None:
+    for target, attr, original in reversed(patched):
+        setattr(target, attr, original)
+
+def import_probe() -> None:
+    """Imports the addon entry point like Anki does at startup and prints the time it took."""
+    with open(os.path.join(ADDON_DIR, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    fake_anki.install_fake_anki(None, config)
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE_NAME, os.path.join(ADDON_DIR, "__init__.py"), submodule_search_locations=[ADDON_DIR]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    start = time.perf_counter()
+    spec.loader.exec_module(package)
+    import_time = time.perf_counter() - start
+    modules = sorted(name[len(PACKAGE_NAME) + 1:] for name in sys.modules if name.startswith(f"{PACKAGE_NAME}."))
+    print(json.dumps({"import_ms": round(import_time * 1000, 2), "modules": modules}))
+
+def measure_import() -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--import-probe"], capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def run_scenario(mw: types.SimpleNamespace, config: Dict[str, Any], scenario: str, size: int) -> Dict[str, Any]:
+    config.clear()
+    config.update(BASE_CONFIG)
+    config.update(SCENARIOS[scenario])
+
+    build_start = time.perf_counter()
+    col = fake_anki.build_collection(size)
+    mw.col = col
+    build_time = time.perf_counter() - build_start
+    cards = importlib.import_module(f"{PACKAGE_NAME}.cards")
+    metrics = sys.modules.get(f"{PACKAGE_NAME}.metrics")
+    # Each scenario starts like a fresh Anki session
+    sys.modules[f"{PACKAGE_NAME}.dictionaries"].dictionary_manager.clear()
+
+    result: Dict[str, Any] = {"scenario": scenario, "size": size, "build_s": round(build_time, 4), "runs": []}
+    for run_name, trigger in (("full", "manual"), ("unchanged", "manual"), ("unchanged_sync", "sync")):
+        stage_times: Dict[str, float] = {}
+        patched = instrument(stage_times)
+        queries_before, searches_before, written_before = col.db.query_count, col.search_count, col.cards_written
+        start = time.perf_counter()
+        try:
+            changes = cards._reorder_cards_with_priority_queue_internal(trigger)
+        finally:
+            total = time.perf_counter() - start
+            restore(patched)
+        result["runs"].append({
+            "run": run_name,
+            "total_s": round(total, 4),
+            "stages_s": {stage: round(seconds, 4) for stage, seconds in stage_times.items()},
+            "metrics": json.loads(metrics.last_run.to_json()) if metrics and metrics.last_run else None,
+            "moved": changes.count,
+            "cards_written": col.cards_written - written_before,
+            "db_queries": col.db.query_count - queries_before,
+            "searches": col.search_count - searches_before,
+        })
+    shutil.rmtree(os.path.dirname(col.path), ignore_errors=True)
+    occurrence_cache = sys.modules.get(f"{PACKAGE_NAME}.occurrence_cache")
+    state = sys.modules.get(f"{PACKAGE_NAME}.state")
+    cache_paths = [occurrence_cache.OccurrenceCountCache.for_collection(col.path).path] if occurrence_cache else []
+    if state:
+        cache_paths += [state._state_path(col, file_name) for file_name in (state.STATE_FILE_NAME, state.FINGERPRINT_FILE_NAME)]
+    for cache_path in cache_paths:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+    return result
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ADDON_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    def index(report: Dict[str, Any]) -> Dict[tuple, float]:
+        return {
+            (result["scenario"], result["size"], run["run"]): run["total_s"]
+            for result in report["results"] for run in result["runs"]
+        }
+    before, after = index(previous), index(current)
+    print(f"\nCompared with {previous['meta'].get('revision')}:")
+    for key in sorted(after):
+        if key in before and before[key] > 0:
+            print(f"  {key[0]:<18} {key[1]:>8} {key[2]:<10} {before[key]:>9.3f}s -> {after[key]:>9.3f}s  x{after[key] / before[key]:.2f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES)
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="previous report to compare totals against")
+    parser.add_argument("--max-import-ms", type=float, help="fail when importing the addon takes longer than this")
+    parser.add_argument("--import-probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.import_probe:
+        import_probe()
+        return
+
+    startup = measure_import()
+    print(f"{'import':<18} {startup['import_ms']:>8.2f}ms  modules={','.join(startup['modules'])}")
+
+    config: Dict[str, Any] = {}
+    mw = load_addon(config)
+    dictionary_dir = os.path.join(ADDON_DIR, "user_files", BENCH_DICTIONARY)
+    results = []
+    try:
+        fake_anki.write_term_meta_bank(dictionary_dir, 30000, banks=3)
+        for size in args.sizes:
+            for scenario in args.scenarios:
+                result = run_scenario(mw, config, scenario, size)
+                results.append(result)
+                for run in result["runs"]:
+                    print(f"{scenario:<18} {size:>8} {run['run']:<14} {run['total_s']:>9.3f}s  moved={run['moved']}  queries={run['db_queries']}")
+    finally:
+        shutil.rmtree(dictionary_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+        },
+        "startup": startup,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+    if args.max_import_ms is not None and startup["import_ms"] > args.max_import_ms:
+        sys.exit(f"Importing the addon took {startup['import_ms']}ms, over the {args.max_import_ms}ms limit")
+
+if __name__ == "__main__":
+    main()
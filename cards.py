@@ -3,22 +3,26 @@ Card operations for priority reorder addon.
 Handles card searching, sorting, and reordering logic.
 """
 
-import re
-from typing import List
-from aqt import mw
-from anki.collection import OpChangesWithCount
+import heapq
+from operator import itemgetter
+from typing import Callable, Dict, List, Set, Tuple
+from anki.collection import Collection, OpChangesWithCount
+from anki.utils import ids2str
 
-from .config import get_current_config
-from .occurrences import rewrite_search_string
+from . import metrics
+from .config import AddonConfig, SearchConfig, get_current_config
+from .fields import chunked
+from .occurrence_cache import OccurrenceCountCache
+from .occurrences import OccurrenceContext, filter_cards_by_occurrences, rewrite_search_string
+from .placement import NORMAL_SECTION, record_layout
+from .plan import ReorderPlan, SearchPlan, get_reorder_plan, profile_plans
+from .reposition import MainWindowProgress, ReorderProgress, get_new_card_positions, reposition_new_cards
+from .sort_keys import SortKey, rank_cards
+from .state import (
+    ReorderState, SortValueCache, compute_input_fingerprint, load_input_fingerprint, load_reorder_state, save_input_fingerprint, save_reorder_state, value_cache_key,
+)
 from .log import *
 
-def get_field_value(card, sort_field: str) -> float:
-    try:
-        value = float(card.note()[sort_field] or 0)
-        return value if value > 0 else float("inf")
-    except (ValueError, KeyError, TypeError):
-        return float("inf")
-
 def should_move_to_priority_queue(value: float, normal_prioritization: int | None, sort_reverse: bool) -> bool:
     return (normal_prioritization is not None and 
             (value > normal_prioritization if sort_reverse else value < normal_prioritization))
@@ -27,51 +31,93 @@ def should_move_to_normal_queue(value: float, priority_cutoff: int | None, sort_
     return (priority_cutoff is not None and 
             (value < priority_cutoff if sort_reverse else value > priority_cutoff))
 
-def get_cards_from_search(search_string: str) -> List[int]:
-    if not search_string.strip():
-        return []
+def _new_cards_query(search: str, card_ids: List[int] | None) -> str:
+    if card_ids is None:
+        return f"{search} is:new"
+    # Grouped, so an "or" in search doesn't leave cards outside card_ids in the result
+    return f"({search} is:new) cid:{','.join(map(str, card_ids))}"
+
+def get_cards_from_search(col: Collection, search: SearchPlan, occurrence_context: OccurrenceContext, card_ids: List[int] | None = None) -> Set[int]:
+    """Ids of the new cards matching search, unordered, only looking among card_ids when given."""
+    if not search.search.strip():
+        return set()
     
     try:
-        rewritten_search = rewrite_search_string(search_string)
-        final_search = f"{rewritten_search} is:new"
-            
-        card_ids = list(mw.col.find_cards(final_search, order="c.due asc"))
+        metrics.count("searches")
+        if search.native_search is None:
+            with metrics.phase("rewrite_search_string"):
+                rewritten_search = rewrite_search_string(search.search, occurrence_context)
+            with metrics.phase("find_cards"):
+                return set(col.find_cards(_new_cards_query(rewritten_search, card_ids)))
         
-        return card_ids
-    except Exception:
-        return []
+        with metrics.phase("find_cards"):
+            card_ids = list(col.find_cards(_new_cards_query(search.native_search, card_ids)))
+        
+        with metrics.phase("occurrence_filter"):
+            return set(filter_cards_by_occurrences(card_ids, list(search.predicates), occurrence_context))
+    except Exception as e:
+        log(WARNING, "Search %r failed, matching no cards: %s", search.search, e)
+        return set()
+
+def get_cards_from_search_once(col: Collection, search: SearchPlan, occurrence_context: OccurrenceContext, search_results: Dict[tuple, Set[int]]) -> Set[int]:
+    """Like get_cards_from_search, reusing the result of an identical search run earlier in the same reorder."""
+    key = (search.search, occurrence_context.search_config)
+    if key not in search_results:
+        search_results[key] = get_cards_from_search(col, search, occurrence_context)
+    return search_results[key]
 
 def sort_card_tuples(card_tuples: List[tuple], sort_reverse: bool) -> List[tuple]:
     card_tuples.sort(key=lambda x: x[1], reverse=sort_reverse)
     return card_tuples
 
-def get_card_tuples_with_field_values(card_ids: List[int], sort_field: str) -> List[tuple]:
-    return [(card_id, get_field_value(mw.col.get_card(card_id), sort_field)) for card_id in card_ids]
+def select_top_card_tuples(card_tuples: List[tuple], count: int | None, sort_reverse: bool) -> tuple[List[tuple], List[tuple]]:
+    """Returns the first count card tuples in sorted order and the unsorted remainder, without sorting everything."""
+    if count is None or count >= len(card_tuples):
+        return sort_card_tuples(card_tuples, sort_reverse), []
+    if count <= 0:
+        return [], card_tuples
+    select = heapq.nlargest if sort_reverse else heapq.nsmallest
+    top_card_tuples = select(count, card_tuples, key=itemgetter(1))
+    top_card_ids = {card_id for card_id, _ in top_card_tuples}
+    return top_card_tuples, [card_tuple for card_tuple in card_tuples if card_tuple[0] not in top_card_ids]
 
-def create_priority_card_buckets(priority_search: List[str], priority_search_mode: str, sort_field: str) -> List[List[tuple]]:
-    priority_card_buckets = []
-    
-    if priority_search_mode == "sequential":
-        for search_string in priority_search:
-            if search_string.strip():
-                card_ids = get_cards_from_search(search_string)
-                if card_ids:
-                    card_tuples = get_card_tuples_with_field_values(card_ids, sort_field)
-                    priority_card_buckets.append(card_tuples)
-    elif priority_search_mode == "mix":
-        combined_priority_ids = []
-        for search_string in priority_search:
-            if search_string.strip():
-                card_ids = get_cards_from_search(search_string)
-                combined_priority_ids.extend(card_ids)
-        
-        if combined_priority_ids:
-            card_tuples = get_card_tuples_with_field_values(combined_priority_ids, sort_field)
-            priority_card_buckets.append(card_tuples)
-    
-    return priority_card_buckets
+def classify_cards(col: Collection, plan: ReorderPlan, positions: Dict[int, int], value_cache: SortValueCache, occurrence_context: OccurrenceContext, search_results: Dict[tuple, Set[int]] | None = None, claimed_card_ids: Set[int] = frozenset()) -> tuple[List[List[tuple]], List[tuple]]:
+    """
+    Runs every search once and assigns each matched card to the first search it matches:
+    the priority searches in order (all of them as one bucket in mix mode), then the normal
+    search. Cards are taken in queue order and their sort values are loaded once, so the
+    buckets and the normal queue are disjoint and each keeps the cards' current order.
+    Cards in claimed_card_ids, already placed by an earlier profile, are left out.
+    """
+    if search_results is None:
+        search_results = {}
+    with metrics.phase("priority_search"):
+        priority_sets = [get_cards_from_search_once(col, search, occurrence_context, search_results) for search in plan.priority_searches]
+    with metrics.phase("normal_search"):
+        normal_set = get_cards_from_search_once(col, plan.normal_search, occurrence_context, search_results)
+    if plan.config.priority_search_mode == "mix":
+        priority_sets = [set().union(*priority_sets)] if priority_sets else []
+    elif plan.config.priority_search_mode != "sequential":
+        priority_sets = []
+
+    with metrics.phase("classify"):
+        # Sorting by id first breaks ties between equal due positions consistently
+        card_ids = sorted(card_id for card_id in normal_set.union(*priority_sets) if card_id in positions and card_id not in claimed_card_ids)
+        card_ids.sort(key=positions.__getitem__)
+        card_tuples = value_cache.get_card_tuples(card_ids)
+
+        priority_card_buckets: List[List[tuple]] = [[] for _ in priority_sets]
+        normal_cards = []
+        for card_tuple in card_tuples:
+            for bucket, matched_ids in zip(priority_card_buckets, priority_sets):
+                if card_tuple[0] in matched_ids:
+                    bucket.append(card_tuple)
+                    break
+            else:
+                normal_cards.append(card_tuple)
+    return [bucket for bucket in priority_card_buckets if bucket], normal_cards
 
-def apply_cutoff_and_prioritization_rules(priority_card_buckets: List[List[tuple]], normal_card_ids: List[int], sort_field: str, priority_cutoff: int | None, normal_prioritization: int | None, sort_reverse: bool) -> tuple[List[List[tuple]], List[tuple]]:
+def apply_cutoff_and_prioritization_rules(priority_card_buckets: List[List[tuple]], normal_cards: List[tuple], priority_cutoff: int | None, normal_prioritization: int | None, sort_reverse: bool) -> tuple[List[List[tuple]], List[tuple]]:
     final_priority_buckets = []
     final_normal_cards = []
     
@@ -87,8 +133,7 @@ def apply_cutoff_and_prioritization_rules(priority_card_buckets: List[List[tuple
         if bucket_priority_cards:
             final_priority_buckets.append(bucket_priority_cards)
     
-    for card_id in normal_card_ids:
-        value = get_field_value(mw.col.get_card(card_id), sort_field)
+    for card_id, value in normal_cards:
         if should_move_to_priority_queue(value, normal_prioritization, sort_reverse):
             if final_priority_buckets:
                 final_priority_buckets[-1].append((card_id, value))
@@ -97,74 +142,280 @@ def apply_cutoff_and_prioritization_rules(priority_card_buckets: List[List[tuple
     
     return final_priority_buckets, final_normal_cards
 
-def sort_priority_cards(final_priority_buckets: List[List[tuple]], mode: str, sort_reverse: bool) -> List[tuple]:
+def rank_by_sort_keys(col: Collection, final_priority_buckets: List[List[tuple]], final_normal_cards: List[tuple], sort_keys: List[SortKey], value_cache: SortValueCache, occurrence_context: OccurrenceContext) -> tuple[List[List[tuple]], List[tuple]]:
+    """
+    Replaces each card's value with its rank under sort_keys, so sorting ascending by value
+    applies them. Each bucket comes out already in ranked order, leaving the later sorts a
+    single pass, but keeps its ranks for the priority limit and mix mode to compare across buckets.
+    """
+    buckets = final_priority_buckets + [final_normal_cards]
+    bucket_indexes = {card_id: index for index, bucket in enumerate(buckets) for card_id, _ in bucket}
+    ranks = rank_cards(col, list(bucket_indexes), sort_keys, value_cache, occurrence_context)
+    ranked_buckets: List[List[tuple]] = [[] for _ in buckets]
+    for card_id, rank in ranks.items():
+        ranked_buckets[bucket_indexes[card_id]].append((card_id, rank))
+    return ranked_buckets[:-1], ranked_buckets[-1]
+
+def sort_priority_cards(final_priority_buckets: List[List[tuple]], mode: str, sort_reverse: bool, limit: int | None = None) -> tuple[List[tuple], List[tuple]]:
+    """Sorts the first limit priority cards, returning them and the unsorted overflow."""
     if mode == "sequential":
         final_priority_cards = []
+        overflow_cards = []
         for bucket in final_priority_buckets:
-            sorted_bucket = sort_card_tuples(bucket, sort_reverse)
+            remaining = None if limit is None else limit - len(final_priority_cards)
+            sorted_bucket, bucket_overflow = select_top_card_tuples(bucket, remaining, sort_reverse)
             final_priority_cards.extend(sorted_bucket)
-        return final_priority_cards
+            overflow_cards.extend(bucket_overflow)
+        return final_priority_cards, overflow_cards
     elif mode == "mix":
         all_priority_cards = []
         for bucket in final_priority_buckets:
             all_priority_cards.extend(bucket)
-        return sort_card_tuples(all_priority_cards, sort_reverse)
+        return select_top_card_tuples(all_priority_cards, limit, sort_reverse)
 
-def apply_priority_limit(final_priority_cards: List[tuple], final_normal_cards: List[tuple], priority_limit: int | None) -> tuple[List[tuple], List[tuple]]:
-    if priority_limit and len(final_priority_cards) > priority_limit:
-        final_normal_cards.extend(final_priority_cards[priority_limit:])
-        final_priority_cards = final_priority_cards[:priority_limit]
+def apply_priority_limit(final_priority_buckets: List[List[tuple]], final_normal_cards: List[tuple], mode: str, sort_reverse: bool, priority_limit: int | None, top_k: int | None = None) -> tuple[List[tuple], List[tuple]]:
+    # Priority cards past top_k are never placed, so they only need selecting once
+    limits = [limit for limit in (priority_limit or None, top_k) if limit is not None]
+    final_priority_cards, overflow_cards = sort_priority_cards(final_priority_buckets, mode, sort_reverse, min(limits) if limits else None)
+    final_normal_cards.extend(overflow_cards)
     return final_priority_cards, final_normal_cards
 
+def get_top_k(col: Collection, config: AddonConfig, card_ids: List[int]) -> int | None:
+    if config.top_k is not None:
+        return max(config.top_k, 0)
+    if not config.top_k_days:
+        return None
+    deck_ids = set()
+    for chunk in chunked(card_ids):
+        # Cards in a filtered deck count towards the limit of their home deck
+        deck_ids.update(col.db.list(f"select distinct coalesce(nullif(odid, 0), did) from cards where id in {ids2str(chunk)}"))
+    new_per_day = 0
+    for deck_id in deck_ids:
+        deck = col.decks.get(deck_id, default=False)
+        # Filtered decks have no deck options, so no new cards/day limit
+        if deck and not deck["dyn"]:
+            new_per_day += col.decks.config_dict_for_deck_id(deck_id)["new"]["perDay"]
+    return new_per_day * config.top_k_days
+
 def reorder_cards_with_priority_queue_manual(_) -> OpChangesWithCount:
     log(DEBUG, "Begining reordering manually")
-    return _reorder_cards_with_priority_queue_internal()
+    return _reorder_cards_with_priority_queue_internal("manual")
 
 def reorder_cards_with_priority_queue_sync_finish() -> OpChangesWithCount:
     log(DEBUG, "Begining reordering on sync finish.")
-    return _reorder_cards_with_priority_queue_internal()
+    return _reorder_cards_with_priority_queue_internal("sync")
 
-def _reorder_cards_with_priority_queue_internal() -> OpChangesWithCount:
+def _reorder_cards_with_priority_queue_internal(trigger: str = "manual") -> OpChangesWithCount:
+    from aqt import mw
     from .config import reload_config
     reload_config()
-    config = get_current_config()
-    if not config.sort_field.strip():
-        return OpChangesWithCount(count=0)
-    
-    priority_card_buckets = create_priority_card_buckets(config.priority_search, config.priority_search_mode, config.sort_field)
-    normal_card_ids = get_cards_from_search(config.normal_search)
-    if not (priority_card_buckets or normal_card_ids):
+    return reorder_collection(mw.col, get_current_config(), trigger, MainWindowProgress(mw))
+
+def reorder_collection(col: Collection, config: AddonConfig, trigger: str = "manual", progress: ReorderProgress | None = None) -> OpChangesWithCount:
+    """Reorders the new cards of col under config. Needs only the anki package, not a running Anki."""
+    plan = get_reorder_plan(config)
+    progress = progress or ReorderProgress()
+    skip_unchanged = config.skip_unchanged_sync
+    with metrics.record_run(trigger, config.profile_reorders) as run:
+        if skip_unchanged and trigger == "sync":
+            with metrics.phase("fingerprint"):
+                unchanged = compute_input_fingerprint(col, config) == load_input_fingerprint(col)
+            if unchanged:
+                log(DEBUG, "Nothing changed since the last reorder, skipping it.")
+                run.count("skipped_unchanged")
+                return OpChangesWithCount(count=0)
+        changes = _reorder_cards(col, plan, progress)
+        run.count("moved_cards", changes.count)
+        # Taken after the write, which changes the cards' mod times
+        if skip_unchanged and not progress.want_cancel():
+            with metrics.phase("fingerprint"):
+                save_input_fingerprint(col, compute_input_fingerprint(col, config))
+        return changes
+
+def _reorder_cards(col: Collection, plan: ReorderPlan, progress: ReorderProgress) -> OpChangesWithCount:
+    config = plan.config
+    profiles = [profile for profile in profile_plans(plan) if profile.config.sort_field.strip() or profile.config.sort_keys]
+    if not profiles:
         return OpChangesWithCount(count=0)
-    
-    final_priority_buckets, final_normal_cards = apply_cutoff_and_prioritization_rules(
-        priority_card_buckets, normal_card_ids, config.sort_field, config.priority_cutoff, config.normal_prioritization, config.sort_reverse
-    )
-    final_priority_cards = sort_priority_cards(final_priority_buckets, config.priority_search_mode, config.sort_reverse)
-    final_priority_cards, final_normal_cards = apply_priority_limit(final_priority_cards, final_normal_cards, config.priority_limit)
-    
-    final_normal_cards = sort_card_tuples(final_normal_cards, config.sort_reverse)
-    
-    # Combines the final card order and removes duplicates
-    final_card_order = list(dict.fromkeys(
-        [card_id for card_id, _ in final_priority_cards + final_normal_cards]
-    ))
-    
-    original_card_order = []
-    match = re.compile(r"deck:\s*([^\s]+)|deck:\s*\"([^\"]+)\"").search(config.normal_search)
-    if match:
-        deck_name = match.group(1) or match.group(2)
-        original_card_order = get_cards_from_search(f"deck:{deck_name} is:new")
+    metrics.count("profiles", len(profiles))
+
+    # Profiles with the same search fields share their occurrence counts, and profiles
+    # sorting by the same field share its loaded values
+    occurrence_contexts: Dict[SearchConfig | None, OccurrenceContext] = {}
+    count_cache = OccurrenceCountCache.for_collection(col.path) if config.cache_occurrence_counts else None
+    value_sources: Dict[str, Tuple[str, OccurrenceContext]] = {}
+    for profile in profiles:
+        search_config = profile.config.search_config
+        occurrence_context = occurrence_contexts.setdefault(search_config, OccurrenceContext(col, search_config, count_cache))
+        value_sources.setdefault(value_cache_key(profile.config.sort_field, search_config), (profile.config.sort_field, occurrence_context))
+    with metrics.phase("positions"):
+        positions = get_new_card_positions(col)
+    reorder_state = None
+    with metrics.phase("load_state"):
+        if config.incremental_reorder:
+            reorder_state = load_reorder_state(col, config, value_sources, positions)
+            value_caches = reorder_state.value_caches
+        else:
+            value_caches = {
+                key: SortValueCache(col, sort_field, occurrence_context=occurrence_context)
+                for key, (sort_field, occurrence_context) in value_sources.items()
+            }
 
-    if not final_card_order or original_card_order == final_card_order:
+    search_results: Dict[tuple, Set[int]] = {}
+    if reorder_state is not None and reorder_state.unchanged:
+        # The cards and their notes are as the last reorder left them, so its order still holds
+        log(DEBUG, "Nothing changed since the last reorder, reapplying its order.")
+        metrics.count("reused_order")
+        final_card_order, deferred_card_ids = reorder_state.order
+        if not final_card_order:
+            return OpChangesWithCount(count=0)
+        with metrics.phase("reposition"):
+            return reposition_new_cards(col, final_card_order, config.shift_existing, set(deferred_card_ids), positions, progress)
+    if reorder_state is not None and reorder_state.dirty_card_ids is not None:
+        with metrics.phase("changed_card_searches"):
+            search_results = _update_search_results(col, profiles, occurrence_contexts, reorder_state)
+    candidate_card_ids: Set[int] = set()
+    final_card_order: List[int] = []
+    profile_sections = []
+    for profile in profiles:
+        search_config = profile.config.search_config
+        sections, tie_ranks, profile_candidates = _order_profile_cards(
+            col, profile, positions, value_caches[value_cache_key(profile.config.sort_field, search_config)],
+            occurrence_contexts[search_config], search_results, candidate_card_ids
+        )
+        # Each profile's cards follow the previous profile's, and a card belongs to the first profile matching it
+        profile_sections.append((profile, sections, tie_ranks))
+        final_card_order.extend(card_id for _, card_ids in sections for card_id in card_ids)
+        candidate_card_ids.update(profile_candidates)
+    last_card_id = max(positions, default=0)
+    
+    if not final_card_order:
+        if config.place_added_cards:
+            record_layout(col, plan, profile_sections, last_card_id)
+        if reorder_state is not None:
+            with metrics.phase("save_state"):
+                save_reorder_state(reorder_state, search_results, [], [], positions)
         log(DEBUG, "No changes in card order.")
         return OpChangesWithCount(count=0)
 
+    metrics.count("candidate_cards", len(candidate_card_ids))
+    metrics.count("ordered_cards", len(final_card_order))
+    deferred_card_ids = candidate_card_ids.difference(final_card_order)
+    with metrics.phase("reposition"):
+        changes = reposition_new_cards(col, final_card_order, config.shift_existing, deferred_card_ids, positions, progress)
+    # A cancelled write restores the previous order, which added cards can't be placed into
+    if config.place_added_cards and not progress.want_cancel():
+        record_layout(col, plan, profile_sections, last_card_id)
+    if reorder_state is not None and not progress.want_cancel():
+        with metrics.phase("save_state"):
+            save_reorder_state(reorder_state, search_results, final_card_order, deferred_card_ids, positions)
     log(DEBUG, "Reorder complete")
 
-    return mw.col.sched.reposition_new_cards(
-        card_ids=final_card_order,
-        starting_from=0,
-        step_size=1,
-        randomize=False,
-        shift_existing=config.shift_existing
-    )
+    return changes
+
+def _update_search_results(col: Collection, profiles: List[ReorderPlan], occurrence_contexts: Dict[SearchConfig | None, OccurrenceContext], reorder_state: ReorderState) -> Dict[tuple, Set[int]]:
+    """
+    The results of the profiles' searches, taken from the last reorder with only the cards
+    changed since searched again. Searches the last reorder didn't run are left out.
+    """
+    dirty_card_ids = sorted(reorder_state.dirty_card_ids)
+    search_results: Dict[tuple, Set[int]] = {}
+    for profile in profiles:
+        occurrence_context = occurrence_contexts[profile.config.search_config]
+        for search in profile.priority_searches + (profile.normal_search,):
+            key = (search.search, occurrence_context.search_config)
+            previous = reorder_state.previous_search_result(*key)
+            if key in search_results or previous is None:
+                continue
+            previous.difference_update(dirty_card_ids)
+            if dirty_card_ids:
+                previous.update(get_cards_from_search(col, search, occurrence_context, dirty_card_ids))
+            search_results[key] = previous
+    metrics.count("changed_cards", len(dirty_card_ids))
+    return search_results
+
+def _section_indexes(col: Collection, plan: ReorderPlan, final_priority_buckets: List[List[tuple]], occurrence_context: OccurrenceContext, search_results: Dict[tuple, Set[int]]) -> Callable[[int], int]:
+    """Maps a priority card to the priority search whose section it's placed in, always the first one in mix mode."""
+    if plan.config.priority_search_mode != "sequential":
+        return lambda card_id: 0
+    priority_sets = [get_cards_from_search_once(col, search, occurrence_context, search_results) for search in plan.priority_searches]
+    def search_index(card_id: int) -> int | None:
+        return next((index for index, matched_ids in enumerate(priority_sets) if card_id in matched_ids), None)
+    # Cards moved up by normal_prioritization match no priority search, and were sorted into the last bucket
+    last_index = 0
+    if final_priority_buckets:
+        last_index = next((index for index in map(search_index, (card_id for card_id, _ in final_priority_buckets[-1])) if index is not None), 0)
+    def section_index(card_id: int) -> int:
+        index = search_index(card_id)
+        return last_index if index is None else index
+    return section_index
+
+def _priority_sections(plan: ReorderPlan, final_priority_cards: List[tuple], section_index: Callable[[int], int]) -> List[Tuple[tuple, List[int]]]:
+    """Splits the ordered priority cards into one section per priority search, or a single one in mix mode."""
+    mode = plan.config.priority_search_mode
+    if mode not in ("sequential", "mix"):
+        return []
+    sections: List[List[int]] = [[] for _ in (plan.priority_searches if mode == "sequential" else [None])]
+    for card_id, _ in final_priority_cards:
+        sections[section_index(card_id)].append(card_id)
+    return [(("priority", index), card_ids) for index, card_ids in enumerate(sections)]
+
+def _tie_ranks(priority_card_buckets: List[List[tuple]], final_priority_buckets: List[List[tuple]], final_priority_cards: List[tuple], final_normal_cards: List[tuple], section_index: Callable[[int], int]) -> Dict[int, tuple]:
+    """
+    Where cards moved by the rules sort among cards with an equal value in their section.
+    In the normal section, cards moved down by priority_cutoff come before the others and
+    cards over priority_limit after them, each in the order of the priority searches they
+    came from. Cards moved up by normal_prioritization come after the cards of the priority
+    search they join. All other cards rank (1,).
+    """
+    matched_ids = {card_id for bucket in priority_card_buckets for card_id, _ in bucket}
+    kept_ids = {card_id for bucket in final_priority_buckets for card_id, _ in bucket}
+    placed_ids = {card_id for card_id, _ in final_priority_cards}
+    tie_ranks = {card_id: (2,) for card_id in placed_ids if card_id not in matched_ids}
+    for card_id, _ in final_normal_cards:
+        if card_id in kept_ids and card_id not in placed_ids:
+            tie_ranks[card_id] = (2, section_index(card_id), int(card_id not in matched_ids))
+        elif card_id in matched_ids:
+            tie_ranks[card_id] = (0, section_index(card_id))
+    return tie_ranks
+
+def _order_profile_cards(col: Collection, plan: ReorderPlan, positions: Dict[int, int], value_cache: SortValueCache, occurrence_context: OccurrenceContext, search_results: Dict[tuple, Set[int]], claimed_card_ids: Set[int]) -> tuple[List[Tuple[tuple, List[int]]], Dict[int, tuple], Set[int]]:
+    """
+    The order of one profile's cards as (section key, card ids) sections, one per priority
+    search and one for the normal cards, their tie ranks when added cards are placed later,
+    and every card in its scope including those it leaves unplaced.
+    """
+    config = plan.config
+    priority_card_buckets, normal_cards = classify_cards(col, plan, positions, value_cache, occurrence_context, search_results, claimed_card_ids)
+    if not (priority_card_buckets or normal_cards):
+        return _priority_sections(plan, [], lambda card_id: 0) + [(NORMAL_SECTION, [])], {}, set()
+    
+    with metrics.phase("rules"):
+        final_priority_buckets, final_normal_cards = apply_cutoff_and_prioritization_rules(
+            priority_card_buckets, normal_cards, config.priority_cutoff, config.normal_prioritization, config.sort_reverse
+        )
+    sort_reverse = config.sort_reverse
+    if plan.sort_keys:
+        with metrics.phase("sort_keys"):
+            final_priority_buckets, final_normal_cards = rank_by_sort_keys(
+                col, final_priority_buckets, final_normal_cards, list(plan.sort_keys), value_cache, occurrence_context
+            )
+        sort_reverse = False
+    candidate_card_ids = {card_id for bucket in final_priority_buckets for card_id, _ in bucket}
+    candidate_card_ids.update(card_id for card_id, _ in final_normal_cards)
+    top_k = get_top_k(col, config, list(candidate_card_ids))
+    with metrics.phase("sort"):
+        final_priority_cards, final_normal_cards = apply_priority_limit(
+            final_priority_buckets, final_normal_cards, config.priority_search_mode, sort_reverse, config.priority_limit, top_k
+        )
+        normal_limit = None if top_k is None else top_k - len(final_priority_cards)
+        final_normal_cards, _ = select_top_card_tuples(final_normal_cards, normal_limit, sort_reverse)
+    
+    # Priority and normal cards are disjoint, so the order needs no deduplication
+    section_index = _section_indexes(col, plan, final_priority_buckets, occurrence_context, search_results)
+    sections = _priority_sections(plan, final_priority_cards, section_index)
+    sections.append((NORMAL_SECTION, [card_id for card_id, _ in final_normal_cards]))
+    tie_ranks = {}
+    if config.place_added_cards:
+        tie_ranks = _tie_ranks(priority_card_buckets, final_priority_buckets, final_priority_cards, final_normal_cards, section_index)
+    return sections, tie_ranks, candidate_card_ids
@@ -0,0 +1,99 @@
+"""
+Reorders Anki collection files from the command line, without opening Anki.
+
+    python cli.py --config server_config.json /srv/learners/*/collection.anki2
+    python cli.py --workers 4 alice.anki2 bob.anki2
+
+Needs the anki package from PyPI, at a version that can open the collections. The
+config file takes the same options as the addon config, and options it leaves out
+keep their values from the addon's config.json. Each collection is opened, reordered
+and closed by one worker process, so several collections are reordered in parallel.
+Collections must not be open in Anki while they are reordered. Each collection's log,
+metrics and profiles are written next to it, so workers never share a file.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_NAME = "priority_reorder"
+
+def _addon_module(name: str) -> types.ModuleType:
+    """Imports an addon module without the addon's __init__, which sets up Anki's main window."""
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [ADDON_DIR]
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+def load_raw_config(path: str | None) -> Dict[str, Any]:
+    with open(os.path.join(ADDON_DIR, "config.json"), encoding="utf-8") as f:
+        raw_config = json.load(f)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            raw_config.update(json.load(f))
+    return raw_config
+
+def reorder_file(path: str, raw_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Reorders one collection file, run in a worker process."""
+    from anki.collection import Collection
+    config_module = _addon_module("config")
+    cards = _addon_module("cards")
+    log = _addon_module("log")
+    metrics = _addon_module("metrics")
+    output_prefix = f"{os.path.splitext(path)[0]}.priority_reorder"
+    log.use_log_file(f"{output_prefix}.debug.log")
+    metrics.use_output_paths(f"{output_prefix}.metrics.jsonl", f"{output_prefix}.profiles")
+    config = config_module.parse_config(raw_config)
+    config_module.use_config(config)
+    result: Dict[str, Any] = {"path": path}
+    start = time.perf_counter()
+    try:
+        col = Collection(path)
+        try:
+            opened = time.perf_counter()
+            result["moved"] = cards.reorder_collection(col, config, "cli").count
+            result["reorder_s"] = time.perf_counter() - opened
+        finally:
+            col.close()
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    finally:
+        log.stop_log_writer()
+    result["total_s"] = time.perf_counter() - start
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("collections", nargs="+", help=".anki2 collection files to reorder")
+    parser.add_argument("--config", help="JSON file of addon options (default: the addon's config.json)")
+    parser.add_argument("--workers", type=int, help="collections reordered at once (default: one per CPU)")
+    args = parser.parse_args()
+
+    raw_config = load_raw_config(args.config)
+    paths = list(dict.fromkeys(os.path.abspath(path) for path in args.collections))
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(paths)))
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reorder_file, path, raw_config) for path in paths]
+        for future in as_completed(futures):
+            result = future.result()
+            if "error" in result:
+                failed += 1
+                print(f"{result['path']}  failed after {result['total_s']:.3f}s: {result['error']}")
+            else:
+                print(f"{result['path']}  {result['total_s']:.3f}s (reorder {result['reorder_s']:.3f}s)  moved={result['moved']}")
+    print(f"Reordered {len(paths) - failed} of {len(paths)} collections in {time.perf_counter() - start:.3f}s with {workers} workers")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compact occurrence index in a single flat buffer, compiled to disk and memory-mapped
+for lookups without parsing, or held in memory when it can't be written.
+
+Layout (native byte order, all integers uint32 unless noted):
+    header: magic, format version, byte order check, source signature (16 bytes),
+            expression entry count, expression+reading entry count
+    expression table: key offsets (n + 1), counts (n), hash slots (m)
+    expression+reading table: key offsets (n + 1), counts (n), hash slots (m)
+    expression key blob, expression+reading key blob
+
+Keys are UTF-8 encoded and sorted bytewise, expression+reading keys are joined
+with KEY_SEPARATOR. Each table has an open addressing hash table of m slots
+(a power of two, at least twice n) keyed by the CRC-32 of the key, holding the
+entry number plus one, or zero for an empty slot.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from typing import Dict, List, Tuple
+
+COMPILED_INDEX_NAME = "occurrence_index.bin"
+KEY_SEPARATOR = b"\x1f"
+
+_MAGIC = b"PRIOOCC\x00"
+_FORMAT_VERSION = 2
+_BYTE_ORDER_CHECK = 0x01020304
+_HEADER = struct.Struct("=8sII16sII")
+
+def source_signature(paths: List[str]) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode("utf-8"))
+    return digest.digest()
+
+def _slot_count(entry_count: int) -> int:
+    return 1 << max(1, (2 * entry_count).bit_length())
+
+def _pack_table(entries: Dict[bytes, int]) -> Tuple[array, array, array, bytes]:
+    keys = sorted(entries)
+    offsets = array("I", [0])
+    counts = array("I")
+    slots = array("I", bytes(4 * _slot_count(len(keys))))
+    mask = len(slots) - 1
+    for entry, key in enumerate(keys):
+        offsets.append(offsets[-1] + len(key))
+        counts.append(entries[key])
+        slot = zlib.crc32(key) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = entry + 1
+    return offsets, counts, slots, b"".join(keys)
+
+def pack_index(expr_to_count: Dict[str, int], expr_reading_to_count: Dict[Tuple[str, str], int], signature: bytes) -> bytes:
+    expr_table = _pack_table({expr.encode("utf-8"): count for expr, count in expr_to_count.items()})
+    pair_table = _pack_table({
+        expr.encode("utf-8") + KEY_SEPARATOR + reading.encode("utf-8"): count
+        for (expr, reading), count in expr_reading_to_count.items()
+    })
+    parts = [_HEADER.pack(_MAGIC, _FORMAT_VERSION, _BYTE_ORDER_CHECK, signature, len(expr_table[1]), len(pair_table[1]))]
+    for offsets, counts, slots, _ in (expr_table, pair_table):
+        parts.extend((offsets.tobytes(), counts.tobytes(), slots.tobytes()))
+    parts.extend((expr_table[3], pair_table[3]))
+    return b"".join(parts)
+
+def write_compiled_index(path: str, expr_to_count: Dict[str, int], expr_reading_to_count: Dict[Tuple[str, str], int], signature: bytes) -> None:
+    data = pack_index(expr_to_count, expr_reading_to_count, signature)
+    # Unique per process, as several processes may compile the same dictionary at once
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class _PackedTable:
+    def __init__(self, offsets: memoryview, counts: memoryview, slots: memoryview, blob: memoryview) -> None:
+        self.offsets = offsets
+        self.counts = counts
+        self.slots = slots
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def get(self, key: bytes) -> int | None:
+        offsets, slots, blob = self.offsets, self.slots, self.blob
+        mask = len(slots) - 1
+        slot = zlib.crc32(key) & mask
+        while entry := slots[slot]:
+            entry -= 1
+            if blob[offsets[entry]:offsets[entry + 1]] == key:
+                return self.counts[entry]
+            slot = (slot + 1) & mask
+        return None
+
+class CompiledOccurrenceIndex:
+    def __init__(self, buffer: mmap.mmap | bytes, expr_count: int, pair_count: int) -> None:
+        self._buffer = buffer
+        view = memoryview(buffer)
+        position = _HEADER.size
+        tables = []
+        for count in (expr_count, pair_count):
+            arrays = []
+            for length in (count + 1, count, _slot_count(count)):
+                arrays.append(view[position:position + 4 * length].cast("I"))
+                position += 4 * length
+            tables.append(arrays)
+        blobs = []
+        for offsets, _, _ in tables:
+            blobs.append(view[position:position + offsets[-1]])
+            position += offsets[-1]
+        if position != len(buffer):
+            raise ValueError("Compiled occurrence index is truncated")
+        self._expr = _PackedTable(*tables[0], blobs[0])
+        self._pair = _PackedTable(*tables[1], blobs[1])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buffer)
+
+    def __len__(self) -> int:
+        return len(self._expr) + len(self._pair)
+
+    def get(self, expression: str, reading: str) -> int:
+        expr_key = expression.encode("utf-8")
+        count = self._pair.get(expr_key + KEY_SEPARATOR + reading.encode("utf-8"))
+        if count is not None:
+            return count
+        count = self._expr.get(expr_key)
+        return count if count is not None else 0
+
+def _parse_header(header: bytes, signature: bytes) -> Tuple[int, int] | None:
+    if len(header) < _HEADER.size:
+        return None
+    magic, version, byte_order, stored_signature, expr_count, pair_count = _HEADER.unpack(header[:_HEADER.size])
+    if (magic, version, byte_order, stored_signature) != (_MAGIC, _FORMAT_VERSION, _BYTE_ORDER_CHECK, signature):
+        return None
+    return expr_count, pair_count
+
+def load_packed_index(data: bytes, signature: bytes) -> CompiledOccurrenceIndex:
+    """Wraps the output of pack_index without writing it to disk."""
+    return CompiledOccurrenceIndex(data, *_parse_header(data, signature))
+
+def open_compiled_index(path: str, signature: bytes) -> CompiledOccurrenceIndex | None:
+    try:
+        with open(path, "rb") as f:
+            counts = _parse_header(f.read(_HEADER.size), signature)
+            if counts is None:
+                return None
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return CompiledOccurrenceIndex(mapping, *counts)
+    except (OSError, ValueError, TypeError):
+        return None
@@ -2,15 +2,23 @@
 Handles loading and managing addon configuration settings.
 """
 
+import json
 from dataclasses import dataclass
-from typing import List
-from aqt import mw
+from typing import Any, Dict, List
+
+from .log import LOG_LEVELS, set_log_level
 
 @dataclass(frozen=True)
 class SearchConfig:
     expression_field: str | None
     expression_reading_field: str | None
 
+# Settings a profile can set for itself, the others apply to all profiles
+PROFILE_SETTINGS = (
+    "priority_search", "priority_search_mode", "normal_search", "sort_field", "sort_reverse", "sort_keys",
+    "priority_cutoff", "normal_prioritization", "priority_limit", "top_k", "top_k_days", "search_fields",
+)
+
 @dataclass(frozen=True)
 class AddonConfig:
     # Basic search configuration
@@ -19,6 +27,7 @@ class AddonConfig:
     normal_search: str
     sort_field: str
     sort_reverse: bool
+    sort_keys: List[str]
     
     # Advanced configuration
     priority_cutoff: int | None
@@ -26,13 +35,21 @@ class AddonConfig:
     priority_limit: int | None
     shift_existing: bool
     reorder_before_sync: bool
+    skip_unchanged_sync: bool
+    place_added_cards: bool
+    incremental_reorder: bool
+    cache_occurrence_counts: bool
+    top_k: int | None
+    top_k_days: int | None
+    profile_reorders: bool
+    dictionary_workers: int | None
+    log_level: str
+    reorder_profiles: List["AddonConfig"]
     
     # Search configuration
     search_config: SearchConfig | None
 
-def get_config() -> AddonConfig:
-    config = mw.addonManager.getConfig(__name__)
-
+def parse_config(config: Dict[str, Any]) -> AddonConfig:
     search_fields = config.get("search_fields", {})
     search_config = None
     if search_fields:
@@ -53,29 +70,64 @@ def get_config() -> AddonConfig:
     if priority_search_mode not in ["sequential", "mix"]:
         priority_search_mode = "sequential"
     
+    log_level = str(config.get("log_level", "INFO")).upper()
+    if log_level not in LOG_LEVELS:
+        log_level = "INFO"
+    
+    # Each profile inherits whatever it doesn't set from the top level settings
+    reorder_profiles = [
+        parse_config({**config, **{key: value for key, value in profile.items() if key in PROFILE_SETTINGS}, "reorder_profiles": []})
+        for profile in config.get("reorder_profiles", None) or [] if isinstance(profile, dict)
+    ]
+    
     return AddonConfig(
         priority_search=priority_search,
         priority_search_mode=priority_search_mode,
         normal_search=config.get("normal_search", ""),
         sort_field=config.get("sort_field", ""),
         sort_reverse=config.get("sort_reverse", False),
+        sort_keys=[str(key) for key in config.get("sort_keys", None) or []],
         priority_cutoff=config.get("priority_cutoff", None),
         normal_prioritization=config.get("normal_prioritization", None),
         priority_limit=config.get("priority_limit", None),
         shift_existing=config.get("shift_existing", True),
         reorder_before_sync=config.get("reorder_before_sync", True),
+        skip_unchanged_sync=config.get("skip_unchanged_sync", True),
+        place_added_cards=config.get("place_added_cards", False),
+        incremental_reorder=config.get("incremental_reorder", False),
+        cache_occurrence_counts=config.get("cache_occurrence_counts", False),
+        top_k=config.get("top_k", None),
+        top_k_days=config.get("top_k_days", None),
+        profile_reorders=config.get("profile_reorders", False),
+        dictionary_workers=config.get("dictionary_workers", None),
+        log_level=log_level,
+        reorder_profiles=reorder_profiles,
         search_config=search_config,
     )
 
-# Global config instance
+# Global config instance, and the raw config it was parsed from
 _config: AddonConfig | None = None
+_config_source: str | None = None
 
 def reload_config():
-    global _config
-    _config = get_config()
+    """Re-reads the addon config, keeping the current AddonConfig instance if nothing changed."""
+    global _config, _config_source
+    from aqt import mw
+    raw_config = mw.addonManager.getConfig(__name__)
+    source = json.dumps(raw_config, sort_keys=True, default=str)
+    if _config is None or source != _config_source:
+        _config = parse_config(raw_config)
+        _config_source = source
+        set_log_level(_config.log_level)
+
+def use_config(config: AddonConfig) -> None:
+    """Makes config the current config when running outside of Anki, where there is no addon config to read."""
+    global _config, _config_source
+    _config = config
+    _config_source = None
+    set_log_level(config.log_level)
 
 def get_current_config() -> AddonConfig:
-    global _config
     if _config is None:
-        _config = get_config()
+        reload_config()
     return _config
@@ -0,0 +1,266 @@
+"""
+Loads Yomitan occurrence dictionaries from user_files into packed occurrence indexes,
+and keeps the loaded ones current.
+"""
+
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from .compiled_index import (
+    COMPILED_INDEX_NAME, CompiledOccurrenceIndex, load_packed_index, open_compiled_index, pack_index, source_signature, write_compiled_index,
+)
+from .config import get_current_config
+from .log import *
+
+TERM_META_BANK_PATTERN = re.compile(r"^term_meta_bank_(\d+)\.json$")
+# Characters of a bank read at once while streaming its entries
+STREAM_CHUNK_SIZE = 1 << 20
+_ARRAY_SEPARATORS = re.compile(r"[\s,]*")
+# Total size of the occurrence indexes kept loaded between reorders
+DICTIONARY_CACHE_BYTES = 256 * 1024 * 1024
+
+class OccurrenceIndex:
+    """Collects counts while a dictionary is parsed, before they are packed into a CompiledOccurrenceIndex."""
+
+    def __init__(self) -> None:
+        self.expr_to_count: Dict[str, int] = {}
+        self.expr_reading_to_count: Dict[Tuple[str, str], int] = {}
+
+    def add(self, expression: str, reading: Optional[str], count: int) -> None:
+        count_dict = self.expr_reading_to_count if reading else self.expr_to_count
+        key = (expression, reading) if reading else expression
+        if key not in count_dict or count < count_dict[key]:
+            count_dict[key] = count
+
+def _dict_dir(dict_name: str) -> str:
+    return os.path.join(os.path.dirname(__file__), "user_files", dict_name)
+
+def _bank_order(name: str) -> int | None:
+    m = TERM_META_BANK_PATTERN.match(os.path.basename(name))
+    return int(m.group(1)) if m else None
+
+def dictionary_sources(dict_dir: str) -> List[str]:
+    """
+    The files a dictionary is read from: its term_meta_bank_*.json files in bank order,
+    or, when the directory holds no extracted banks, the Yomitan .zip files in it.
+    """
+    if not os.path.isdir(dict_dir):
+        return []
+    names = os.listdir(dict_dir)
+    banks = sorted((_bank_order(name), name) for name in names if _bank_order(name) is not None)
+    if banks:
+        return [os.path.join(dict_dir, name) for _, name in banks]
+    return [os.path.join(dict_dir, name) for name in sorted(names) if name.lower().endswith(".zip")]
+
+def _dictionary_banks(sources: List[str]) -> List[Tuple[str, str | None]]:
+    """(path, zip member or None) of every bank in sources, in bank order."""
+    banks = []
+    for path in sources:
+        if not path.lower().endswith(".zip"):
+            banks.append((path, None))
+            continue
+        with zipfile.ZipFile(path) as archive:
+            members = sorted((_bank_order(name), name) for name in archive.namelist() if _bank_order(name) is not None)
+        banks.extend((path, member) for _, member in members)
+    return banks
+
+@contextmanager
+def _open_bank(path: str, member: str | None) -> Iterator[TextIO]:
+    if member is None:
+        with open(path, "r", encoding="utf-8") as f:
+            yield f
+    else:
+        with zipfile.ZipFile(path) as archive, archive.open(member) as raw:
+            yield io.TextIOWrapper(raw, encoding="utf-8")
+
+def iter_json_array(f: TextIO) -> Iterator[Any]:
+    """Yields the elements of the JSON array in f one at a time, reading STREAM_CHUNK_SIZE characters at once."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(STREAM_CHUNK_SIZE).lstrip("\ufeff \t\r\n")
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    eof = False
+    while True:
+        pos = _ARRAY_SEPARATORS.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+        # An element that ends the buffer may continue in the next chunk
+        if end is None or (end == len(buffer) and not eof):
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            continue
+        yield value
+        pos = end
+
+def _entry_count(entry: Any) -> Tuple[str, str | None, int] | None:
+    if not isinstance(entry, list) or len(entry) < 3:
+        return None
+    expression = entry[0]
+    meta = entry[2] if isinstance(entry[2], dict) else {}
+    reading = meta.get("reading") if isinstance(meta.get("reading"), str) else None
+    count = 0
+    freq_obj = meta.get("frequency")
+    if isinstance(freq_obj, dict) and isinstance(freq_obj.get("value"), int):
+        count = int(freq_obj["value"])
+    elif isinstance(meta.get("value"), int):
+        count = int(meta["value"])
+    if isinstance(expression, str) and count > 0:
+        return expression, reading, count
+    return None
+
+def _add_bank(index: OccurrenceIndex, bank: Tuple[str, str | None]) -> None:
+    with _open_bank(*bank) as f:
+        for entry in iter_json_array(f):
+            parsed = _entry_count(entry)
+            if parsed:
+                index.add(*parsed)
+
+def _parse_bank(bank: Tuple[str, str | None]) -> Tuple[Dict[str, int], Dict[Tuple[str, str], int]]:
+    """Process pool worker, parses a single bank."""
+    index = OccurrenceIndex()
+    _add_bank(index, bank)
+    return index.expr_to_count, index.expr_reading_to_count
+
+def parse_dictionary(sources: List[str], workers: int | None = None) -> OccurrenceIndex:
+    """
+    Streams every bank of the dictionary into one index. With more than one worker the
+    banks are parsed in a process pool and merged, keeping the lowest count of duplicates
+    like a serial parse does.
+    """
+    banks = _dictionary_banks(sources)
+    index = OccurrenceIndex()
+    # Frozen Anki builds cannot start Python worker processes
+    if workers and workers > 1 and len(banks) > 1 and not getattr(sys, "frozen", False):
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(banks))) as pool:
+                for expr_to_count, expr_reading_to_count in pool.map(_parse_bank, banks):
+                    for expression, count in expr_to_count.items():
+                        index.add(expression, None, count)
+                    for (expression, reading), count in expr_reading_to_count.items():
+                        index.add(expression, reading, count)
+            return index
+        except Exception as e:
+            # Whatever went wrong in a worker, a serial parse decides whether the dictionary loads
+            log(WARNING, "Parsing dictionary banks in parallel failed, parsing serially: %s", e)
+            index = OccurrenceIndex()
+    for bank in banks:
+        _add_bank(index, bank)
+    return index
+
+def dictionary_version(dict_name: str) -> str:
+    sources = dictionary_sources(_dict_dir(dict_name))
+    return source_signature(sources).hex() if sources else ""
+
+def _compile_index(dir_path: str, sources: List[str]) -> CompiledOccurrenceIndex:
+    signature = source_signature(sources)
+    compiled_path = os.path.join(dir_path, COMPILED_INDEX_NAME)
+    compiled = open_compiled_index(compiled_path, signature)
+    if compiled:
+        return compiled
+
+    index = parse_dictionary(sources, get_current_config().dictionary_workers)
+    try:
+        write_compiled_index(compiled_path, index.expr_to_count, index.expr_reading_to_count, signature)
+        compiled = open_compiled_index(compiled_path, signature)
+    except OSError:
+        pass
+    # Kept in memory in the same packed layout when the directory isn't writable
+    return compiled or load_packed_index(pack_index(index.expr_to_count, index.expr_reading_to_count, signature), signature)
+
+def _empty_index() -> CompiledOccurrenceIndex:
+    signature = bytes(16)
+    return load_packed_index(pack_index({}, {}, signature), signature)
+
+def _load_occurrence_index(dict_name: str) -> CompiledOccurrenceIndex:
+    dir_path = _dict_dir(dict_name)
+    sources = dictionary_sources(dir_path)
+    if not sources:
+        return _empty_index()
+    
+    try:
+        return _compile_index(dir_path, sources)
+    except Exception as e:
+        log(WARNING, "Failed to load dictionary %s: %s", dict_name, e)
+        return _empty_index()
+
+class DictionaryManager:
+    """
+    Loaded occurrence indexes, each stored with the version of the files it was built
+    from. A lookup reloads a dictionary whose files changed since it was loaded, and the
+    least recently used indexes are dropped once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, Tuple[str, CompiledOccurrenceIndex]] = OrderedDict()
+        # Held while loading, so a reorder waits for a prewarm of the same dictionary instead of parsing it twice
+        self._lock = threading.Lock()
+        self._prewarm_thread: threading.Thread | None = None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(index.nbytes for _, index in self._entries.values())
+
+    def lookup(self, dict_name: str) -> Tuple[CompiledOccurrenceIndex, bool]:
+        """The current index of dict_name, and whether it was already loaded."""
+        version = dictionary_version(dict_name)
+        with self._lock:
+            entry = self._entries.get(dict_name)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(dict_name)
+                return entry[1], True
+            if entry is not None:
+                log(DEBUG, "Dictionary %s changed, reloading it.", dict_name)
+                # Unmaps the old compiled index once nothing else uses it, so it can be replaced
+                del self._entries[dict_name]
+                entry = None
+            index = _load_occurrence_index(dict_name)
+            self._entries[dict_name] = (version, index)
+            # The newest index stays even when it alone is over budget
+            while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+                self._entries.popitem(last=False)
+            return index, False
+
+    def get(self, dict_name: str) -> CompiledOccurrenceIndex:
+        return self.lookup(dict_name)[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def prewarm(self, dict_names: List[str]) -> None:
+        """Loads dict_names in a background thread, so the first reorder finds them loaded."""
+        if not dict_names or (self._prewarm_thread and self._prewarm_thread.is_alive()):
+            return
+        self._prewarm_thread = threading.Thread(
+            target=self._prewarm, args=(list(dict_names),), name="priority-reorder-prewarm", daemon=True
+        )
+        self._prewarm_thread.start()
+
+    def _prewarm(self, dict_names: List[str]) -> None:
+        for dict_name in dict_names:
+            start = time.perf_counter()
+            _, loaded = self.lookup(dict_name)
+            if not loaded:
+                log(DEBUG, "Prewarmed dictionary %s in %.2fs.", dict_name, time.perf_counter() - start)
+
+dictionary_manager = DictionaryManager(DICTIONARY_CACHE_BYTES)
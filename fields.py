@@ -0,0 +1,79 @@
+"""
+Batched note field loading straight from the collection database.
+"""
+
+from typing import Dict, Iterator, List, Tuple
+from anki.collection import Collection
+from anki.utils import ids2str
+
+from . import metrics
+
+FIELD_SEPARATOR = "\x1f"
+QUERY_CHUNK_SIZE = 10000
+
+def chunked(ids: List[int], size: int = QUERY_CHUNK_SIZE) -> Iterator[List[int]]:
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def get_field_index(col: Collection, mid: int, field_name: str, index_cache: Dict[int, int | None]) -> int | None:
+    if mid not in index_cache:
+        model = col.models.get(mid)
+        field = col.models.field_map(model).get(field_name) if model else None
+        index_cache[mid] = field[0] if field else None
+    return index_cache[mid]
+
+def split_field(flds: str, index: int | None) -> str | None:
+    if index is None:
+        return None
+    fields = flds.split(FIELD_SEPARATOR)
+    return fields[index] if index < len(fields) else None
+
+def parse_field_value(raw_value: str | None) -> float:
+    try:
+        value = float(raw_value or 0)
+        return value if value > 0 else float("inf")
+    except (ValueError, TypeError):
+        return float("inf")
+
+def load_card_fields(col: Collection, card_ids: List[int], field_name: str) -> Dict[int, Tuple[int, str | None]]:
+    """Maps each card id to its note id and the raw content of field_name (None if the notetype lacks it)."""
+    index_cache: Dict[int, int | None] = {}
+    raw_values: Dict[int, Tuple[int, str | None]] = {}
+    for chunk in chunked(card_ids):
+        rows: List[Tuple[int, int, int, str]] = col.db.all(
+            f"select c.id, n.id, n.mid, n.flds from cards c join notes n on c.nid = n.id where c.id in {ids2str(chunk)}"
+        )
+        metrics.count("db_queries")
+        metrics.count("cards_loaded", len(rows))
+        for card_id, note_id, mid, flds in rows:
+            raw_values[card_id] = (note_id, split_field(flds, get_field_index(col, mid, field_name, index_cache)))
+    return raw_values
+
+def load_note_field_strings(col: Collection, note_ids: List[int], field_names: List[str]) -> Dict[int, Tuple[str | None, ...]]:
+    """Maps each note id to the raw content of each of field_names, in order."""
+    index_caches: List[Dict[int, int | None]] = [{} for _ in field_names]
+    raw_values: Dict[int, Tuple[str | None, ...]] = {}
+    for chunk in chunked(note_ids):
+        rows: List[Tuple[int, int, str]] = col.db.all(f"select id, mid, flds from notes where id in {ids2str(chunk)}")
+        metrics.count("db_queries")
+        metrics.count("notes_loaded", len(rows))
+        for note_id, mid, flds in rows:
+            raw_values[note_id] = tuple(
+                split_field(flds, get_field_index(col, mid, field_name, index_cache))
+                for field_name, index_cache in zip(field_names, index_caches)
+            )
+    return raw_values
+
+def load_note_mods(col: Collection, note_ids: List[int]) -> Dict[int, int]:
+    note_mods: Dict[int, int] = {}
+    for chunk in chunked(note_ids):
+        note_mods.update(col.db.all(f"select id, mod from notes where id in {ids2str(chunk)}"))
+        metrics.count("db_queries")
+    return note_mods
+
+def get_card_note_ids(col: Collection, card_ids: List[int]) -> Dict[int, int]:
+    note_ids: Dict[int, int] = {}
+    for chunk in chunked(card_ids):
+        note_ids.update(col.db.all(f"select id, nid from cards where id in {ids2str(chunk)}"))
+        metrics.count("db_queries")
+    return note_ids
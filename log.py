@@ -1,21 +1,15 @@
 """
 Debug logging utility
+
+Messages are put on a queue by the thread that logs them and written to the log
+file by a background listener thread, so file writes and rotation never block a
+reorder. Messages below the configured log_level are dropped before formatting.
 """
 
+import atexit
 import os
 import logging
-from logging.handlers import RotatingFileHandler
-
-fh = RotatingFileHandler(
-    os.path.join(os.path.dirname(__file__), 'debug.log'),
-    maxBytes=1024 * 1024,
-    backupCount=0
-)
-fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s(%(levelno)s) - %(message)s'))
-
-logger = logging.getLogger('priority-reorder')
-logger.addHandler(fh)
-logger.setLevel(logging.DEBUG)
+import threading
 
 DEBUG = 10
 INFO = 20
@@ -23,16 +17,75 @@ WARNING = 30
 ERROR = 40
 CRITICAL = 50
 
-def log(level: int, message: str) -> None:
-    global logger
-    if level == DEBUG:
-        logger.debug(message)
-    elif level == INFO:
-        logger.info(message)
-    elif level == WARNING:
-        logger.warning(message)
-    elif level == ERROR:
-        logger.error(message)
-    elif level == CRITICAL:
-        logger.critical(message)
+LOG_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR, "CRITICAL": CRITICAL}
+LOG_FILE = os.path.join(os.path.dirname(__file__), 'debug.log')
+
+logger = logging.getLogger('priority-reorder')
+logger.setLevel(INFO)
+logger.propagate = False
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def set_log_level(level_name: str) -> None:
+    logger.setLevel(LOG_LEVELS[level_name])
+
+def _start_listener() -> None:
+    """Creates the file handler and its writer thread on the first message"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = _create_listener()
+
+def _create_listener():
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+    try:
+        from .config import get_current_config
+        set_log_level(get_current_config().log_level)
+    except Exception:
+        # Logging must not raise, as it's also called from except blocks, so the level
+        # stays at its default when the config can't be read
+        pass
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=1024 * 1024, backupCount=0)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s(%(levelno)s) - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    logger.addHandler(QueueHandler(log_queue))
+    # Writes out what is still queued when Anki exits
+    atexit.register(listener.stop)
+    return listener
+
+def stop_log_writer() -> None:
+    """
+    Writes out the queued messages and stops the writer thread, which the next message
+    starts again. For processes that exit without running atexit handlers.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        atexit.unregister(_listener.stop)
+        for handler in _listener.handlers:
+            handler.close()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        _listener = None
+
+def use_log_file(path: str) -> None:
+    """Writes the following messages to path, as each process reordering outside Anki keeps its own log."""
+    global LOG_FILE
+    stop_log_writer()
+    LOG_FILE = path
 
+def log(level: int, message: str, *args) -> None:
+    """Logs message % args. The arguments are only formatted when level is enabled."""
+    if not logger.isEnabledFor(level):
+        return
+    if _listener is None:
+        _start_listener()
+    # Starting the listener may have read a higher level from the config
+    if logger.isEnabledFor(level):
+        logger.log(level, message, *args)
@@ -0,0 +1,122 @@
+"""
+Per-reorder phase timings and counters, written as one JSON line per run to a
+rotating metrics file. Optionally captures a cProfile dump for the slowest runs.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Iterator
+
+METRICS_FILE = os.path.join(os.path.dirname(__file__), "metrics.jsonl")
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), "profiles")
+KEEP_SLOWEST_PROFILES = 5
+
+_metrics_logger: logging.Logger | None = None
+
+def use_output_paths(metrics_file: str, profile_dir: str) -> None:
+    """Writes the following runs' metrics and profiles to these paths instead of the addon folder."""
+    global METRICS_FILE, PROFILE_DIR, _metrics_logger
+    if _metrics_logger is not None:
+        for handler in list(_metrics_logger.handlers):
+            _metrics_logger.removeHandler(handler)
+            handler.close()
+        _metrics_logger = None
+    METRICS_FILE = metrics_file
+    PROFILE_DIR = profile_dir
+
+def _get_metrics_logger() -> logging.Logger:
+    global _metrics_logger
+    if _metrics_logger is None:
+        handler = RotatingFileHandler(METRICS_FILE, maxBytes=1024 * 1024, backupCount=2, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _metrics_logger = logging.getLogger("priority-reorder.metrics")
+        _metrics_logger.propagate = False
+        _metrics_logger.addHandler(handler)
+        _metrics_logger.setLevel(logging.INFO)
+    return _metrics_logger
+
+class ReorderMetrics:
+    def __init__(self, trigger: str) -> None:
+        self.trigger = trigger
+        self.started_at = time.time()
+        self.total = 0.0
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "started_at": round(self.started_at, 3),
+            "trigger": self.trigger,
+            "total_ms": round(self.total * 1000, 1),
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            "counters": self.counters,
+        }, ensure_ascii=False)
+
+# Metrics of the reorder currently running, None outside a reorder
+_current: ReorderMetrics | None = None
+last_run: ReorderMetrics | None = None
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    if _current is None:
+        yield
+    else:
+        with _current.phase(name):
+            yield
+
+def count(name: str, amount: int = 1) -> None:
+    if _current is not None:
+        _current.count(name, amount)
+
+def _profile_name(total: float) -> str:
+    return f"reorder_{int(total * 1000):010d}ms_{int(time.time())}.prof"
+
+def _keep_slowest_profile(profiler: cProfile.Profile, total: float) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # Names start with the zero-padded duration, so sorting them sorts by duration
+    existing = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".prof"))
+    name = _profile_name(total)
+    if len(existing) >= KEEP_SLOWEST_PROFILES and name < existing[0]:
+        return
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    for stale in sorted(existing + [name])[:-KEEP_SLOWEST_PROFILES]:
+        os.remove(os.path.join(PROFILE_DIR, stale))
+
+@contextmanager
+def record_run(trigger: str, profile: bool = False) -> Iterator[ReorderMetrics]:
+    global _current, last_run
+    run = _current = ReorderMetrics(trigger)
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield run
+    finally:
+        if profiler:
+            profiler.disable()
+        run.total = time.perf_counter() - start
+        _current = None
+        last_run = run
+        try:
+            _get_metrics_logger().info(run.to_json())
+            if profiler:
+                _keep_slowest_profile(profiler, run.total)
+        except OSError:
+            pass
@@ -0,0 +1,111 @@
+"""
+Occurrence counts of notes stored between reorders in a SQLite database in user_files,
+one per collection. Each count is stored with the mod time of the note it was computed
+for, and each dictionary with the version of its files, so a reorder only looks up the
+notes edited since and the dictionaries replaced since. Occurrence terms are answered
+with range queries over the stored counts.
+"""
+
+import hashlib
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Set
+
+from . import metrics
+from .log import *
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "user_files")
+
+_SCHEMA = """
+create table if not exists sources (id integer primary key, source text not null unique, version text not null);
+create table if not exists counts (
+    source_id integer not null,
+    note_id integer not null,
+    note_mod integer not null,
+    count integer not null,
+    primary key (source_id, note_id)
+) without rowid;
+create index if not exists ix_counts_source_count on counts (source_id, count);
+"""
+
+# Occurrence term operators, checked before they are put in a query
+_SQL_OPERATORS = {"=": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+
+class OccurrenceCountCache:
+    """
+    Counts keyed by source, a dictionary and the fields its counts are looked up with,
+    and note id. A source holds exactly the notes of the last update.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @classmethod
+    def for_collection(cls, collection_path: str) -> "OccurrenceCountCache":
+        digest = hashlib.sha1(os.path.abspath(collection_path).encode("utf-8")).hexdigest()[:16]
+        return cls(os.path.join(CACHE_DIR, f"occurrence_counts_{digest}.sqlite3"))
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per call, as reorders run on whichever background thread is free
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path)
+        try:
+            db.executescript(_SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def update(self, source: str, version: str, note_mods: Dict[int, int], compute: Callable[[List[int]], List[int]]) -> None:
+        """
+        Makes source hold the counts of exactly the notes in note_mods (note id to mod
+        time). compute gives the counts of the note ids it is passed, and is only called
+        for notes edited since their count was stored, or for all of them when version
+        changed. The stored counts themselves aren't read.
+        """
+        with self._connect() as db:
+            row = db.execute("select id, version from sources where source = ?", (source,)).fetchone()
+            cached_mods: Dict[int, int] = {}
+            if row is None:
+                source_id = db.execute("insert into sources (source, version) values (?, ?)", (source, version)).lastrowid
+            elif row[1] == version:
+                source_id = row[0]
+                cached_mods = dict(db.execute("select note_id, note_mod from counts where source_id = ?", (source_id,)))
+            else:
+                source_id = row[0]
+                db.execute("delete from counts where source_id = ?", (source_id,))
+                db.execute("update sources set version = ? where id = ?", (version, source_id))
+            metrics.count("db_queries")
+
+            stale_note_ids = [note_id for note_id, note_mod in note_mods.items() if cached_mods.get(note_id) != note_mod]
+            gone_note_ids = [note_id for note_id in cached_mods if note_id not in note_mods]
+            metrics.count("occurrence_cache_hits", len(note_mods) - len(stale_note_ids))
+            metrics.count("occurrence_cache_misses", len(stale_note_ids))
+            if gone_note_ids:
+                db.executemany("delete from counts where source_id = ? and note_id = ?", ((source_id, note_id) for note_id in gone_note_ids))
+            if stale_note_ids:
+                db.executemany(
+                    "insert or replace into counts values (?, ?, ?, ?)",
+                    ((source_id, note_id, note_mods[note_id], count) for note_id, count in zip(stale_note_ids, compute(stale_note_ids))),
+                )
+        if stale_note_ids or gone_note_ids:
+            log(DEBUG, "Occurrence counts of %s: %d recomputed, %d dropped.", source.replace("\x1f", " "), len(stale_note_ids), len(gone_note_ids))
+
+    def counts(self, source: str) -> Dict[int, int]:
+        """The counts of the notes of the last update of source."""
+        with self._connect() as db:
+            metrics.count("db_queries")
+            return dict(db.execute(
+                "select c.note_id, c.count from counts c join sources s on c.source_id = s.id where s.source = ?", (source,)
+            ))
+
+    def matching_note_ids(self, source: str, op: str, thresh: int) -> Set[int]:
+        """Ids of the notes of the last update of source whose count compares to thresh with op."""
+        with self._connect() as db:
+            metrics.count("db_queries")
+            return {note_id for (note_id,) in db.execute(
+                f"select c.note_id from counts c join sources s on c.source_id = s.id where s.source = ? and c.count {_SQL_OPERATORS[op]} ?",
+                (source, thresh),
+            )}
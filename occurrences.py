@@ -1,154 +1,306 @@
 """
-Handles Yomitan dictionary parsing and occurrence-based search patterns.
+Handles occurrence-based search patterns.
 """
 
-import json
-import os
+import operator
 import re
-from functools import lru_cache
-from typing import Dict, Optional, Tuple, Callable
-
-from anki.notes import Note
+import sqlite3
+from array import array
+from dataclasses import dataclass, field
+from functools import reduce
+from itertools import compress, repeat
+from typing import Dict, Iterable, List, Set, Tuple, Callable
+from anki.collection import Collection
 
+from . import metrics
+from .compiled_index import CompiledOccurrenceIndex
 from .config import SearchConfig
+from .dictionaries import dictionary_manager, dictionary_version
+from .fields import get_card_note_ids, load_note_field_strings, load_note_mods
+from .occurrence_cache import OccurrenceCountCache
+from .log import *
 
 # Occurrence search pattern
 OCC_PATTERN = re.compile(r"^occurrences:(?P<dict>[^=<>!]+)(?P<op>>=|<=|!=|=|<|>)(?P<thresh>\d+)$")
+# Occurrence sort key, used as sort_field
+OCC_SORT_PATTERN = re.compile(r"^occurrences:(?P<dict>[^=<>!]+)$")
+# Aggregate over several dictionaries, e.g. sum(A,B), max(A,B) or wsum(A*2,B)
+AGGREGATE_PATTERN = re.compile(r"^(?P<func>sum|max|wsum)\((?P<args>[^()]+)\)$")
+WEIGHT_PATTERN = re.compile(r"^(?P<dict>.+)\*(?P<weight>\d+(?:\.\d+)?)$")
+# Sort key source referenced in a sort score, e.g. {FreqSort} or {occurrences:A}
+SCORE_REFERENCE = re.compile(r"\{([^{}]+)\}")
+
+_AGGREGATE_FUNCTIONS: Dict[str, Callable] = {
+    "sum": operator.add,
+    "wsum": operator.add,
+    "max": max,
+}
+
+@dataclass(frozen=True)
+class OccurrencePredicate:
+    dict_name: str
+    op: str
+    thresh: int
+    negated: bool
+    compare: Callable[[int, int], bool] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "compare", parse_operator(self.op))
+
+@dataclass(frozen=True)
+class OccurrenceExpression:
+    func: str | None
+    dict_names: Tuple[str, ...]
+    weights: Tuple[int | float, ...]
 
-class OccurrenceIndex:
-    def __init__(self) -> None:
-        self.expr_to_count: Dict[str, int] = {}
-        self.expr_reading_to_count: Dict[Tuple[str, str], int] = {}
+def parse_occurrence_expression(text: str) -> OccurrenceExpression:
+    """Parses the part of an occurrences: term naming the dictionary, or an aggregate over several."""
+    text = text.strip()
+    m = AGGREGATE_PATTERN.match(text)
+    if not m:
+        return OccurrenceExpression(None, (text,), (1,))
+    dict_names = []
+    weights = []
+    for arg in m.group("args").split(","):
+        arg = arg.strip()
+        weighted = WEIGHT_PATTERN.match(arg) if m.group("func") == "wsum" else None
+        if weighted:
+            weight = weighted.group("weight")
+            dict_names.append(weighted.group("dict").strip())
+            weights.append(float(weight) if "." in weight else int(weight))
+        else:
+            dict_names.append(arg)
+            weights.append(1)
+    if not all(dict_names):
+        raise ValueError(f"Empty dictionary name in {text}")
+    return OccurrenceExpression(m.group("func"), tuple(dict_names), tuple(weights))
 
-    def add(self, expression: str, reading: Optional[str], count: int) -> None:
-        count_dict = self.expr_reading_to_count if reading else self.expr_to_count
-        key = (expression, reading) if reading else expression
-        if key not in count_dict or count < count_dict[key]:
-            count_dict[key] = count
+def aggregate_counts(expression: OccurrenceExpression, columns: List[array]) -> array:
+    """Combines aligned per-note count arrays element by element."""
+    typecode = "d" if any(isinstance(weight, float) for weight in expression.weights) else "q"
+    weighted = [
+        column if weight == 1 else array(typecode, map(operator.mul, column, repeat(weight)))
+        for column, weight in zip(columns, expression.weights)
+    ]
+    combine = _AGGREGATE_FUNCTIONS[expression.func]
+    return array(typecode, reduce(lambda total, column: map(combine, total, column), weighted))
 
-    def get(self, expression: str, reading: str) -> int:
-        if (expression, reading) in self.expr_reading_to_count:
-            return self.expr_reading_to_count[(expression, reading)]
-        return self.expr_to_count.get(expression, 0)
+def occurrence_sort_expression(sort_field: str) -> str | None:
+    m = OCC_SORT_PATTERN.match(sort_field.strip())
+    return m.group("dict").strip() if m else None
 
 def parse_operator(op: str) -> Callable[[int, int], bool]:
     match op:
         case "=":
-            return lambda a, b: a == b
+            return operator.eq
         case "!=":
-            return lambda a, b: a != b
+            return operator.ne
         case "<":
-            return lambda a, b: a < b
+            return operator.lt
         case "<=":
-            return lambda a, b: a <= b
+            return operator.le
         case ">":
-            return lambda a, b: a > b
+            return operator.gt
         case ">=":
-            return lambda a, b: a >= b
+            return operator.ge
         case _:
             raise ValueError(f"Unsupported operator: {op}")
 
-def _dict_dir(dict_name: str) -> str:
-    return os.path.join(os.path.dirname(__file__), "user_files", dict_name)
+def peel_search_term(term: str) -> Tuple[str, str, str]:
+    """Splits the opening parentheses and negations before a term and the closing parentheses after it off the term."""
+    core = term.lstrip("(-")
+    prefix = term[:len(term) - len(core)]
+    # Only unbalanced parentheses close a group, the rest belong to aggregates like sum(A,B)
+    end = len(core)
+    while end and core[end - 1] == ")" and core.count(")", 0, end) > core.count("(", 0, end):
+        end -= 1
+    return prefix, core[:end], core[end:]
 
-def _load_index_file(dict_dir: str) -> Optional[str]:
-    if not os.path.isdir(dict_dir):
-        return None
-    for name in os.listdir(dict_dir):
-        if name.startswith("term_meta_bank_") and name.endswith(".json"):
-            return os.path.join(dict_dir, name)
-    return None
-
-def _parse_term_meta_bank(path: str) -> OccurrenceIndex:
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    index = OccurrenceIndex()
-    for entry in data:
-        if not isinstance(entry, list) or len(entry) < 3:
-            continue
-        expression = entry[0]
-        meta = entry[2] if isinstance(entry[2], dict) else {}
-        reading = meta.get("reading") if isinstance(meta.get("reading"), str) else None
-        count = 0
-        freq_obj = meta.get("frequency")
-        if isinstance(freq_obj, dict) and isinstance(freq_obj.get("value"), int):
-            count = int(freq_obj["value"])
-        elif isinstance(meta.get("value"), int):
-            count = int(meta["value"])
-        if isinstance(expression, str) and count > 0:
-            index.add(expression, reading, count)
-    return index
-
-@lru_cache(maxsize=32)
-def get_occurrence_index(dict_name: str) -> OccurrenceIndex:
-    dir_path = _dict_dir(dict_name)
-    index_path = _load_index_file(dir_path)
-    if not index_path:
-        return OccurrenceIndex()
-    
-    try:
-        return _parse_term_meta_bank(index_path)
-    except Exception:
-        return OccurrenceIndex()
+def referenced_dictionaries(searches: List[str]) -> List[str]:
+    dict_names = []
+    for search in searches:
+        for term in search.split():
+            term = peel_search_term(term)[1]
+            score_reference = SCORE_REFERENCE.search(term)
+            if score_reference:
+                term = score_reference.group(1)
+            m = OCC_PATTERN.match(term) or OCC_SORT_PATTERN.match(term)
+            if not m:
+                continue
+            try:
+                expression = parse_occurrence_expression(m.group("dict"))
+            except ValueError:
+                continue
+            dict_names.extend(name for name in expression.dict_names if name not in dict_names)
+    return dict_names
 
-def _note_occurrence_count(note: Note, index: OccurrenceIndex, cfg: SearchConfig | None) -> int:
+def _occurrence_count(index: CompiledOccurrenceIndex, expr: str | None, reading: str | None) -> int:
     try:
-        if not cfg or not cfg.expression_field or not cfg.expression_reading_field:
-            return 0
-        if cfg.expression_field not in note or cfg.expression_reading_field not in note:
-            return 0
-        expr = note[cfg.expression_field]
-        reading = note[cfg.expression_reading_field]
         if not expr or not reading:
             return 0
         return index.get(expr, reading)
     except Exception:
         return 0
 
-def get_search_config() -> SearchConfig | None:
-    from .config import get_current_config
-    return get_current_config().search_config
+def note_occurrence_count(dict_name: str, expression: str | None, reading: str | None) -> int | float:
+    """Occurrence count of a single note, without loading the counts of every note like OccurrenceContext."""
+    occurrence_expression = parse_occurrence_expression(dict_name)
+    counts = [_occurrence_count(dictionary_manager.get(name), expression, reading) for name in occurrence_expression.dict_names]
+    if occurrence_expression.func is None:
+        return counts[0]
+    return aggregate_counts(occurrence_expression, [array("q", [count]) for count in counts])[0]
+
+def note_matches_predicates(predicates: Iterable[OccurrencePredicate], expression: str | None, reading: str | None) -> bool:
+    """Whether a single note passes every occurrence term, like filter_cards_by_occurrences. Notes missing either field match no term."""
+    for predicate in predicates:
+        try:
+            matched = bool(expression and reading) and predicate.compare(note_occurrence_count(predicate.dict_name, expression, reading), predicate.thresh)
+        except Exception:
+            matched = False
+        if matched == predicate.negated:
+            return False
+    return True
 
-def rewrite_search_string(search: str) -> str:
+class OccurrenceContext:
+    """
+    Occurrence data shared by every search in one reorder. The candidate notes and their
+    expression fields are loaded once, and each dictionary's counts once as an array
+    aligned with them, so every occurrence term is just a comparison over that array.
+    Aggregates combine those arrays, and are cached like a single dictionary's counts.
+    With a count_cache, counts stored by earlier reorders are reused, and only the fields
+    of notes edited since are loaded.
+    """
+
+    def __init__(self, col: Collection, search_config: SearchConfig | None, count_cache: OccurrenceCountCache | None = None) -> None:
+        self.col = col
+        self.search_config = search_config
+        self.count_cache = count_cache
+        self._note_ids: array | None = None
+        self._note_mods: Dict[int, int] = {}
+        self._expressions: List[Tuple[str | None, str | None]] = []
+        self._counts: Dict[str, array] = {}
+        # Dictionaries whose stored counts were brought up to date in this reorder
+        self._updated_sources: Set[str] = set()
+        self._matches: Dict[Tuple[str, str, int], Set[int]] = {}
+        self._note_counts: Dict[str, Dict[int, int | float]] = {}
+
+    def has_search_fields(self) -> bool:
+        cfg = self.search_config
+        return bool(cfg and cfg.expression_field and cfg.expression_reading_field)
+
+    def note_ids(self) -> array:
+        if self._note_ids is None:
+            cfg = self.search_config
+            # all new cards with the required fields 
+            query = f"{cfg.expression_field}:* {cfg.expression_reading_field}:* is:new"
+            note_ids = list(self.col.find_notes(query))
+            metrics.count("searches")
+            self._note_ids = array("q", note_ids)
+            if self.count_cache is None:
+                self._expressions = self._load_expressions(note_ids)
+            else:
+                self._note_mods = load_note_mods(self.col, note_ids)
+        return self._note_ids
+
+    def _load_expressions(self, note_ids: List[int]) -> List[Tuple[str | None, str | None]]:
+        cfg = self.search_config
+        fields = load_note_field_strings(self.col, note_ids, [cfg.expression_field, cfg.expression_reading_field])
+        return [fields.get(nid, (None, None)) for nid in note_ids]
+
+    def _lookup_counts(self, dict_name: str, expressions: List[Tuple[str | None, str | None]]) -> List[int]:
+        with metrics.phase("dictionary_load"):
+            index, cached = dictionary_manager.lookup(dict_name)
+            metrics.count("dictionary_cache_hits" if cached else "dictionary_cache_misses")
+        with metrics.phase("occurrence_counts"):
+            return [_occurrence_count(index, expr, reading) for expr, reading in expressions]
+
+    def _cache_source(self, dict_name: str) -> str:
+        cfg = self.search_config
+        return "\x1f".join([dict_name, cfg.expression_field, cfg.expression_reading_field])
+
+    def _update_count_cache(self, dict_name: str) -> None:
+        if dict_name not in self._updated_sources:
+            self.note_ids()
+            self.count_cache.update(
+                self._cache_source(dict_name), dictionary_version(dict_name), self._note_mods,
+                lambda stale_note_ids: self._lookup_counts(dict_name, self._load_expressions(stale_note_ids)),
+            )
+            self._updated_sources.add(dict_name)
+
+    def _drop_count_cache(self, err: sqlite3.Error) -> None:
+        log(WARNING, "Occurrence count cache unavailable, looking up every note: %s", err)
+        self.count_cache = None
+        self._expressions = self._load_expressions(list(self.note_ids()))
+
+    def counts(self, dict_name: str) -> array:
+        if dict_name in self._counts:
+            return self._counts[dict_name]
+        expression = parse_occurrence_expression(dict_name)
+        if expression.func is not None:
+            columns = [self.counts(name) for name in expression.dict_names]
+            with metrics.phase("occurrence_aggregate"):
+                self._counts[dict_name] = aggregate_counts(expression, columns)
+        else:
+            note_ids = self.note_ids()
+            if self.count_cache is not None:
+                try:
+                    with metrics.phase("occurrence_cache"):
+                        self._update_count_cache(dict_name)
+                        note_counts = self.count_cache.counts(self._cache_source(dict_name))
+                    self._counts[dict_name] = array("q", [note_counts[nid] for nid in note_ids])
+                    return self._counts[dict_name]
+                except sqlite3.Error as err:
+                    self._drop_count_cache(err)
+            self._counts[dict_name] = array("q", self._lookup_counts(dict_name, self._expressions))
+        return self._counts[dict_name]
+
+    def matching_note_ids(self, dict_name: str, op: str, thresh: int, compare: Callable[[int, int], bool] | None = None) -> Set[int] | None:
+        if not self.has_search_fields():
+            return None
+        key = (dict_name, op, thresh)
+        if key not in self._matches and self.count_cache is not None and parse_occurrence_expression(dict_name).func is None:
+            try:
+                with metrics.phase("occurrence_cache"):
+                    # Only brings the stored counts up to date, the range query needs no count array
+                    self._update_count_cache(dict_name)
+                    self._matches[key] = self.count_cache.matching_note_ids(self._cache_source(dict_name), op, thresh)
+            except sqlite3.Error as err:
+                self._drop_count_cache(err)
+        if key not in self._matches:
+            cmp_fn = compare or parse_operator(op)
+            self._matches[key] = set(compress(self.note_ids(), map(cmp_fn, self.counts(dict_name), repeat(thresh))))
+        return self._matches[key]
+
+    def card_values(self, dict_name: str, card_ids: List[int]) -> Dict[int, Tuple[int, int | float]]:
+        """(note id, count) of each card, for sorting by occurrences. Cards without counts get 0."""
+        note_ids = get_card_note_ids(self.col, card_ids)
+        if not self.has_search_fields():
+            return {card_id: (note_id, 0) for card_id, note_id in note_ids.items()}
+        if dict_name not in self._note_counts:
+            self._note_counts[dict_name] = dict(zip(self.note_ids(), self.counts(dict_name)))
+        note_counts = self._note_counts[dict_name]
+        return {card_id: (note_id, note_counts.get(note_id, 0)) for card_id, note_id in note_ids.items()}
+
+def rewrite_search_string(search: str, context: OccurrenceContext) -> str:
     if "occurrences:" not in search:
         return search
     
     try:
-        from aqt import mw
-        terms = search.split()
         new_terms = []
         
-        for term in terms:
-            if OCC_PATTERN.match(term):
+        for term, _ in tokenize_search(search):
+            # Occurrence terms may open or close a group, or be negated, as in -(occurrences:A>=50 or tag:x)
+            prefix, core, suffix = peel_search_term(term)
+            m = OCC_PATTERN.match(core)
+            if m:
                 try:
-                    m = OCC_PATTERN.match(term)
-                    dict_name = m.group("dict").strip()
-                    op = m.group("op")
-                    thresh = int(m.group("thresh"))
-                    
-                    cfg = get_search_config()
-                    if not cfg or (not cfg.expression_field or not cfg.expression_reading_field):
+                    matching_nids = context.matching_note_ids(m.group("dict").strip(), m.group("op"), int(m.group("thresh")))
+                    if matching_nids is None:
                         new_terms.append(term)
-                        continue
-                    
-                    # all new cards with the required fields 
-                    query = f"{cfg.expression_field}:* {cfg.expression_reading_field}:* is:new"
-                    note_ids = mw.col.find_notes(query)
-                    
-                    index = get_occurrence_index(dict_name)
-                    cmp_fn = parse_operator(op)
-                    matching_nids = []
-                    
-                    for nid in note_ids:
-                        note = mw.col.get_note(nid)
-                        count = _note_occurrence_count(note, index, cfg)
-                        if cmp_fn(count, thresh):
-                            matching_nids.append(str(nid))
-                    
-                    if not matching_nids:
-                        new_terms.append("nid:999999999")
+                    elif not matching_nids:
+                        new_terms.append(f"{prefix}nid:999999999{suffix}")
                     else:
-                        new_terms.append(f"nid:{','.join(matching_nids)}")
+                        new_terms.append(f"{prefix}nid:{','.join(map(str, sorted(matching_nids)))}{suffix}")
                         
                 except Exception:
                     new_terms.append(term)
@@ -160,3 +312,70 @@ def rewrite_search_string(search: str) -> str:
     except Exception:
         # If anything goes wrong, return original search
         return search
+
+def tokenize_search(search: str) -> List[Tuple[str, int]]:
+    """Splits a search on whitespace outside quotes, pairing each term with its parenthesis depth."""
+    tokens = []
+    current = []
+    depth = token_depth = 0
+    in_quote = escaped = False
+    for char in search:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            in_quote = not in_quote
+        elif not in_quote and char.isspace():
+            if current:
+                tokens.append(("".join(current), token_depth))
+                current = []
+            continue
+        elif not in_quote and char == "(":
+            depth += 1
+        elif not in_quote and char == ")":
+            depth -= 1
+        if not current:
+            token_depth = depth - 1 if char == "(" and not in_quote else depth
+        current.append(char)
+    if current:
+        tokens.append(("".join(current), token_depth))
+    return tokens
+
+def split_search_string(search: str) -> Tuple[str, List[OccurrencePredicate]] | None:
+    """
+    Separates top-level occurrences: terms from the native Anki search. Returns None when
+    an occurrence term is nested in a group or joined with "or", which needs rewrite_search_string.
+    """
+    tokens = tokenize_search(search)
+    native_terms = []
+    predicates = []
+    for term, depth in tokens:
+        negated = term.startswith("-")
+        m = OCC_PATTERN.match(term[1:] if negated else term)
+        if m and depth == 0:
+            predicates.append(OccurrencePredicate(m.group("dict").strip(), m.group("op"), int(m.group("thresh")), negated))
+        elif "occurrences:" in term:
+            return None
+        else:
+            native_terms.append(term)
+    if predicates and any(term.lower() == "or" and depth == 0 for term, depth in tokens):
+        return None
+    return " ".join(native_terms), predicates
+
+def filter_cards_by_occurrences(card_ids: List[int], predicates: List[OccurrencePredicate], context: OccurrenceContext) -> List[int]:
+    if not predicates or not card_ids:
+        return card_ids
+    
+    note_ids = get_card_note_ids(context.col, card_ids)
+    kept_nids = set(note_ids.values())
+    for predicate in predicates:
+        try:
+            matching_nids = context.matching_note_ids(predicate.dict_name, predicate.op, predicate.thresh, predicate.compare) or set()
+        except Exception:
+            matching_nids = set()
+        if predicate.negated:
+            kept_nids -= matching_nids
+        else:
+            kept_nids &= matching_nids
+    return [card_id for card_id in card_ids if note_ids.get(card_id) in kept_nids]
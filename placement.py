@@ -0,0 +1,255 @@
+"""
+Places cards added since the last reorder straight into its order, instead of running
+a full reorder. The order of the last reorder is kept in memory as one section per
+priority search, and one for the normal search, of each profile. An added card is
+classified on its own, and its place in its section is found by a binary search over
+the sort values of the cards already there.
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from anki.collection import Collection, OpChangesWithCount
+
+from . import metrics
+from .config import AddonConfig, get_current_config, reload_config
+from .fields import get_field_index, parse_field_value, split_field
+from .occurrences import note_matches_predicates, note_occurrence_count, occurrence_sort_expression
+from .plan import ReorderPlan, SearchPlan, get_reorder_plan
+from .log import *
+
+NORMAL_SECTION = ("normal",)
+
+class CannotPlace(Exception):
+    """The queue no longer matches the last reorder, or the card needs a full reorder to be placed."""
+
+@dataclass
+class LayoutSection:
+    profile: ReorderPlan
+    # ("priority", priority search index) or NORMAL_SECTION
+    key: tuple
+    card_ids: List[int]
+    # Tie ranks of the profile's cards other than (1,), shared by all its sections
+    tie_ranks: Dict[int, tuple]
+
+@dataclass
+class QueueLayout:
+    config_hash: str
+    collection_path: str
+    # Cards with a larger id were added after the layout was recorded
+    last_card_id: int
+    sections: List[LayoutSection]
+
+    def profiles(self) -> List[ReorderPlan]:
+        return list({id(section.profile): section.profile for section in self.sections}.values())
+
+_layout: QueueLayout | None = None
+
+def record_layout(col: Collection, plan: ReorderPlan, profile_sections: List[Tuple[ReorderPlan, List[Tuple[tuple, List[int]]], Dict[int, tuple]]], last_card_id: int) -> None:
+    """Remembers the order a reorder wrote, as (profile, [(section key, card ids in order)], tie ranks) in queue order."""
+    global _layout
+    _layout = QueueLayout(plan.config_hash, col.path, last_card_id, [
+        LayoutSection(profile, key, list(card_ids), tie_ranks)
+        for profile, sections, tie_ranks in profile_sections for key, card_ids in sections
+    ])
+
+def clear_layout() -> None:
+    global _layout
+    _layout = None
+
+class _CardReader:
+    """Reads the sort value and expression fields of single cards for one profile."""
+
+    def __init__(self, col: Collection, config: AddonConfig) -> None:
+        self.col = col
+        self.config = config
+        self.occurrence_expression = occurrence_sort_expression(config.sort_field)
+        self._index_caches: Dict[str, Dict[int, int | None]] = {}
+        self._rows: Dict[int, Tuple[int, str]] = {}
+
+    def _field(self, card_id: int, field_name: str | None) -> str | None:
+        if card_id not in self._rows:
+            row = self.col.db.first("select n.mid, n.flds from cards c join notes n on c.nid = n.id where c.id = ? and c.type = 0", card_id)
+            metrics.count("db_queries")
+            if row is None:
+                raise CannotPlace(f"card {card_id} is no longer new")
+            self._rows[card_id] = row
+        if not field_name:
+            return None
+        mid, flds = self._rows[card_id]
+        return split_field(flds, get_field_index(self.col, mid, field_name, self._index_caches.setdefault(field_name, {})))
+
+    def expression_fields(self, card_id: int) -> Tuple[str | None, str | None]:
+        search_config = self.config.search_config
+        if not search_config:
+            return None, None
+        return self._field(card_id, search_config.expression_field), self._field(card_id, search_config.expression_reading_field)
+
+    def value(self, card_id: int) -> float:
+        if self.occurrence_expression:
+            expression, reading = self.expression_fields(card_id)
+            return note_occurrence_count(self.occurrence_expression, expression, reading) if expression and reading else 0
+        return parse_field_value(self._field(card_id, self.config.sort_field))
+
+def _card_due(col: Collection, card_id: int) -> int:
+    due = col.db.scalar("select due from cards where id = ? and type = 0", card_id)
+    metrics.count("db_queries")
+    if due is None:
+        raise CannotPlace(f"card {card_id} is no longer new")
+    return due
+
+def _matches(search: SearchPlan, card_id: int, reader: _CardReader) -> bool:
+    if not search.search.strip():
+        return False
+    if search.native_search is None:
+        raise CannotPlace(f"occurrence terms nested in {search.search}")
+    native_search = search.native_search.strip()
+    try:
+        metrics.count("searches")
+        if not reader.col.find_cards(f"({native_search}) cid:{card_id} is:new" if native_search else f"cid:{card_id} is:new"):
+            return False
+    except Exception:
+        return False
+    return not search.predicates or note_matches_predicates(search.predicates, *reader.expression_fields(card_id))
+
+def _section_key(profile: ReorderPlan, sections: List[LayoutSection], card_id: int, reader: _CardReader) -> Tuple[tuple, tuple] | None:
+    """
+    The section of profile the card belongs in, with the cutoff and prioritization rules
+    applied, and its tie rank there. None if the card is out of the profile's scope.
+    """
+    from .cards import should_move_to_normal_queue, should_move_to_priority_queue
+    config = profile.config
+    key = None
+    if config.priority_search_mode in ("sequential", "mix"):
+        for index, search in enumerate(profile.priority_searches):
+            if _matches(search, card_id, reader):
+                key = ("priority", index if config.priority_search_mode == "sequential" else 0)
+                break
+    if key is None:
+        if not _matches(profile.normal_search, card_id, reader):
+            return None
+        key = NORMAL_SECTION
+
+    value = reader.value(card_id)
+    if key != NORMAL_SECTION and should_move_to_normal_queue(value, config.priority_cutoff, config.sort_reverse):
+        return NORMAL_SECTION, (0, key[1])
+    if key == NORMAL_SECTION and should_move_to_priority_queue(value, config.normal_prioritization, config.sort_reverse):
+        # Like a full reorder, prioritized cards join the last priority search that has cards
+        priority_keys = [section.key for section in sections if section.key != NORMAL_SECTION and section.card_ids]
+        if priority_keys:
+            return priority_keys[-1], (2,)
+    return key, (1,)
+
+def _insertion_index(section: LayoutSection, value: float, tie_rank: tuple, reader: _CardReader) -> int:
+    """Index after the cards sorting before the card, or equal to it, like a stable sort with the card added last."""
+    reverse = section.profile.config.sort_reverse
+    low, high = 0, len(section.card_ids)
+    while low < high:
+        middle = (low + high) // 2
+        middle_card_id = section.card_ids[middle]
+        middle_value = reader.value(middle_card_id)
+        if middle_value == value:
+            sorts_after = section.tie_ranks.get(middle_card_id, (1,)) > tie_rank
+        else:
+            sorts_after = (middle_value < value) if reverse else (middle_value > value)
+        if sorts_after:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def _target_due(col: Collection, layout: QueueLayout, section: LayoutSection, index: int) -> int | None:
+    if index < len(section.card_ids):
+        return _card_due(col, section.card_ids[index])
+    if section.card_ids:
+        return _card_due(col, section.card_ids[-1]) + 1
+    position = layout.sections.index(section)
+    for later in layout.sections[position + 1:]:
+        if later.card_ids:
+            return _card_due(col, later.card_ids[0])
+    for earlier in reversed(layout.sections[:position]):
+        if earlier.card_ids:
+            return _card_due(col, earlier.card_ids[-1]) + 1
+    return None
+
+def _insert(layout: QueueLayout, section: LayoutSection, card_id: int, tie_rank: tuple, reader: _CardReader) -> bool:
+    index = _insertion_index(section, reader.value(card_id), tie_rank, reader)
+    config = section.profile.config
+    if section.key == NORMAL_SECTION and index == len(section.card_ids) and (config.top_k is not None or config.top_k_days):
+        # Past the cards a top_k reorder sorts, where the card already is
+        return False
+    target_due = _target_due(reader.col, layout, section, index)
+    if target_due is None:
+        return False
+    reader.col.sched.reposition_new_cards(
+        card_ids=[card_id],
+        starting_from=target_due,
+        step_size=1,
+        randomize=False,
+        shift_existing=True
+    )
+    section.card_ids.insert(index, card_id)
+    if tie_rank != (1,):
+        section.tie_ranks[card_id] = tie_rank
+    else:
+        section.tie_ranks.pop(card_id, None)
+    return True
+
+def _place_card(col: Collection, layout: QueueLayout, card_id: int, readers: Dict[int, _CardReader]) -> int:
+    """Places one added card in the first profile whose searches it matches, returning how many cards moved."""
+    for profile in layout.profiles():
+        if profile.sort_keys:
+            raise CannotPlace("sort_keys rank cards against all the others")
+        reader = readers.setdefault(id(profile), _CardReader(col, profile.config))
+        sections = [section for section in layout.sections if section.profile is profile]
+        classified = _section_key(profile, sections, card_id, reader)
+        if classified is None:
+            continue
+        key, tie_rank = classified
+        section = next((section for section in sections if section.key == key), None)
+        if section is None:
+            raise CannotPlace(f"no {key} section in the last reorder")
+        if not _insert(layout, section, card_id, tie_rank, reader):
+            return 0
+
+        priority_limit = profile.config.priority_limit or None
+        priority_sections = [section for section in sections if section.key != NORMAL_SECTION]
+        if key == NORMAL_SECTION or priority_limit is None or sum(len(section.card_ids) for section in priority_sections) <= priority_limit:
+            return 1
+        # The last priority card is now over the limit, and sorts into the normal cards instead
+        displaced_from = [section for section in priority_sections if section.card_ids][-1]
+        displaced_card_id = displaced_from.card_ids.pop()
+        prioritized = displaced_from.tie_ranks.get(displaced_card_id) == (2,)
+        normal_section = next(section for section in sections if section.key == NORMAL_SECTION)
+        return 1 + _insert(layout, normal_section, displaced_card_id, (2, displaced_from.key[1], int(prioritized)), reader)
+    return 0
+
+def place_added_cards(_=None) -> OpChangesWithCount:
+    """Places the cards added since the last reorder, running a full reorder when they can't be placed on their own."""
+    from aqt import mw
+    from .cards import _reorder_cards_with_priority_queue_internal
+    col = mw.col
+    reload_config()
+    plan = get_reorder_plan(get_current_config())
+    layout = _layout
+    if layout is None or layout.config_hash != plan.config_hash or layout.collection_path != col.path:
+        log(DEBUG, "No previous reorder to place added cards into, running a full reorder.")
+        return _reorder_cards_with_priority_queue_internal("add")
+
+    with metrics.record_run("add") as run:
+        added_card_ids = col.db.list("select id from cards where type = 0 and id > ? order by id", layout.last_card_id)
+        readers: Dict[int, _CardReader] = {}
+        moved = 0
+        undo_entry = col.add_custom_undo_entry("Place New Cards")
+        try:
+            for card_id in added_card_ids:
+                moved += _place_card(col, layout, card_id, readers)
+                layout.last_card_id = card_id
+        except CannotPlace as err:
+            col.merge_undo_entries(undo_entry)
+            clear_layout()
+            log(DEBUG, "Can't place added cards on their own (%s), running a full reorder.", err)
+        else:
+            run.count("moved_cards", moved)
+            log(DEBUG, "Placed %d added cards, moving %d.", len(added_card_ids), moved)
+            return OpChangesWithCount(count=moved, changes=col.merge_undo_entries(undo_entry))
+    return _reorder_cards_with_priority_queue_internal("add")
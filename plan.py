@@ -0,0 +1,67 @@
+"""
+Reorder plan compiled from the addon config once, and reused by every reorder until
+the config changes.
+"""
+
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+from typing import Tuple
+
+from .config import AddonConfig
+from .occurrences import OccurrencePredicate, referenced_dictionaries, split_search_string
+from .sort_keys import SortKey, parse_sort_keys
+
+@dataclass(frozen=True)
+class SearchPlan:
+    search: str
+    # None when occurrence terms are nested or joined with "or" and need rewrite_search_string
+    native_search: str | None
+    predicates: Tuple[OccurrencePredicate, ...]
+
+@dataclass(frozen=True)
+class ReorderPlan:
+    config_hash: str
+    config: AddonConfig
+    priority_searches: Tuple[SearchPlan, ...]
+    normal_search: SearchPlan
+    sort_keys: Tuple[SortKey, ...]
+    dictionaries: Tuple[str, ...]
+    # One plan per configured profile, empty when the top level settings are the only profile
+    profiles: Tuple["ReorderPlan", ...]
+
+def compile_search(search: str) -> SearchPlan:
+    split_search = split_search_string(search)
+    if split_search is None:
+        return SearchPlan(search, None, ())
+    native_search, predicates = split_search
+    return SearchPlan(search, native_search, tuple(predicates))
+
+def config_hash(config: AddonConfig) -> str:
+    return hashlib.sha1(json.dumps(asdict(config), sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def compile_plan(config: AddonConfig) -> ReorderPlan:
+    profiles = tuple(compile_plan(profile) for profile in config.reorder_profiles)
+    dictionaries = referenced_dictionaries(config.priority_search + [config.normal_search, config.sort_field] + config.sort_keys)
+    return ReorderPlan(
+        config_hash=config_hash(config),
+        config=config,
+        priority_searches=tuple(compile_search(search) for search in config.priority_search if search.strip()),
+        normal_search=compile_search(config.normal_search),
+        sort_keys=tuple(parse_sort_keys(config.sort_keys)),
+        dictionaries=tuple(dict.fromkeys(dictionaries + [name for profile in profiles for name in profile.dictionaries])),
+        profiles=profiles,
+    )
+
+def profile_plans(plan: ReorderPlan) -> Tuple[ReorderPlan, ...]:
+    """The plans to run in one reorder, in the order their cards are placed."""
+    return plan.profiles or (plan,)
+
+_plan: ReorderPlan | None = None
+
+def get_reorder_plan(config: AddonConfig) -> ReorderPlan:
+    """The plan for config, compiled only when config differs from the last one."""
+    global _plan
+    if _plan is None or (_plan.config is not config and _plan.config_hash != config_hash(config)):
+        _plan = compile_plan(config)
+    return _plan
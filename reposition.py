@@ -0,0 +1,149 @@
+"""
+Writes the computed card order, repositioning only the cards whose due position changes,
+in bounded chunks that can be cancelled.
+"""
+
+from typing import Any, Dict, List, Set, Tuple
+from anki.collection import Collection, OpChangesWithCount
+
+from . import metrics
+from .log import *
+
+# Beyond this many separate runs a single call over the changed span is cheaper
+MAX_REPOSITION_RUNS = 100
+# Most cards written by one backend call, bounding the size of each change set
+REPOSITION_CHUNK_SIZE = 5000
+
+class ReorderProgress:
+    """Progress of writing the order and requests to cancel it, ignored outside of Anki's main window."""
+
+    def update(self, done: int, total: int) -> None:
+        pass
+
+    def want_cancel(self) -> bool:
+        return False
+
+class MainWindowProgress(ReorderProgress):
+    """Shows progress in the main window's progress dialog, whose cancel button stops the write."""
+
+    def __init__(self, mw: Any) -> None:
+        self.mw = mw
+
+    def update(self, done: int, total: int) -> None:
+        self.mw.taskman.run_on_main(
+            lambda: self.mw.progress.update(label=f"Reordering cards... {done}/{total}", value=done, max=total)
+        )
+
+    def want_cancel(self) -> bool:
+        return self.mw.progress.want_cancel()
+
+def get_new_card_positions(col: Collection) -> Dict[int, int]:
+    metrics.count("db_queries")
+    return dict(col.db.all("select id, due from cards where type = 0"))
+
+def _cards_to_keep_behind(final_card_order: List[int], positions: Dict[int, int], shift_existing: bool, deferred_card_ids: Set[int]) -> List[Tuple[int, int]]:
+    """(due, card id) of the new cards that have to stay behind final_card_order."""
+    if not shift_existing:
+        return [(positions[card_id], card_id) for card_id in deferred_card_ids if card_id in positions]
+    in_order = set(final_card_order)
+    return [(due, card_id) for card_id, due in positions.items() if card_id not in in_order]
+
+def is_already_ordered(final_card_order: List[int], positions: Dict[int, int], shift_existing: bool, deferred_card_ids: Set[int] = frozenset()) -> bool:
+    previous_due = None
+    for card_id in final_card_order:
+        due = positions.get(card_id)
+        if due is None or (previous_due is not None and due <= previous_due):
+            return False
+        previous_due = due
+    if previous_due is None:
+        return True
+    return all(due > previous_due for due, _ in _cards_to_keep_behind(final_card_order, positions, shift_existing, deferred_card_ids))
+
+def _push_behind(cards: List[Tuple[int, int]], first_free: int) -> List[Tuple[int, int]]:
+    """
+    (target, card id) moves that put cards, sorted (due, card id) pairs, at or after
+    first_free without changing their order. Cards already far enough back stay put.
+    """
+    moves = []
+    for due, card_id in cards:
+        if due >= first_free:
+            first_free = due + 1
+        else:
+            moves.append((first_free, card_id))
+            first_free += 1
+    return moves
+
+def _runs_from_moves(moves: List[Tuple[int, int]]) -> List[Tuple[int, List[int]]]:
+    runs: List[Tuple[int, List[int]]] = []
+    for target, card_id in moves:
+        if runs and runs[-1][0] + len(runs[-1][1]) == target:
+            runs[-1][1].append(card_id)
+        else:
+            runs.append((target, [card_id]))
+    return runs
+
+def plan_repositions(final_card_order: List[int], positions: Dict[int, int], shift_existing: bool, deferred_card_ids: Set[int] = frozenset()) -> List[Tuple[int, List[int]]]:
+    """
+    Returns (starting position, card ids) runs that place final_card_order at positions
+    0..n-1, skipping cards already there. Deferred cards (in scope but left out of the
+    order) that sit inside that range are moved to the end of the queue. With
+    shift_existing, other new cards in the way are pushed back behind the order,
+    keeping their relative order.
+    """
+    total = len(final_card_order)
+    runs = _runs_from_moves([
+        (target, card_id) for target, card_id in enumerate(final_card_order) if positions.get(card_id) != target
+    ])
+    if len(runs) > MAX_REPOSITION_RUNS:
+        first = runs[0][0]
+        last = runs[-1][0] + len(runs[-1][1])
+        runs = [(first, final_card_order[first:last])]
+
+    behind = sorted(_cards_to_keep_behind(final_card_order, positions, shift_existing, deferred_card_ids))
+    colliding_deferred = [card_id for due, card_id in behind if due < total and card_id in deferred_card_ids]
+    if colliding_deferred:
+        runs.append((max(max(positions.values()) + 1, total), colliding_deferred))
+        moved_to_end = set(colliding_deferred)
+        behind = [(due, card_id) for due, card_id in behind if card_id not in moved_to_end]
+    runs.extend(_runs_from_moves(_push_behind(behind, total)))
+    return runs
+
+def chunk_runs(runs: List[Tuple[int, List[int]]], chunk_size: int = REPOSITION_CHUNK_SIZE) -> List[Tuple[int, List[int]]]:
+    """Splits runs into runs of at most chunk_size cards, each keeping its final positions."""
+    return [
+        (starting_from + offset, card_ids[offset:offset + chunk_size])
+        for starting_from, card_ids in runs
+        for offset in range(0, len(card_ids), chunk_size)
+    ]
+
+def reposition_new_cards(col: Collection, final_card_order: List[int], shift_existing: bool, deferred_card_ids: Set[int] = frozenset(), positions: Dict[int, int] | None = None, progress: ReorderProgress | None = None) -> OpChangesWithCount:
+    """Places final_card_order at the front of the new queue. positions are the current due of every new card, if already read."""
+    if positions is None:
+        positions = get_new_card_positions(col)
+    progress = progress or ReorderProgress()
+    if is_already_ordered(final_card_order, positions, shift_existing, deferred_card_ids):
+        log(DEBUG, "No changes in card order.")
+        return OpChangesWithCount(count=0)
+
+    chunks = chunk_runs(plan_repositions(final_card_order, positions, shift_existing, deferred_card_ids))
+    moved = sum(len(card_ids) for _, card_ids in chunks)
+    log(DEBUG, "Repositioning %d cards for an order of %d in %d chunks.", moved, len(final_card_order), len(chunks))
+    metrics.count("reposition_calls", len(chunks))
+    # Every chunk is merged into this entry, so the whole reorder is undone at once
+    undo_entry = col.add_custom_undo_entry("Reorder Cards")
+    done = 0
+    for starting_from, card_ids in chunks:
+        if progress.want_cancel():
+            col.merge_undo_entries(undo_entry)
+            log(INFO, "Reorder cancelled after %d of %d cards, restoring the previous order.", done, moved)
+            return OpChangesWithCount(count=0, changes=col.undo().changes)
+        col.sched.reposition_new_cards(
+            card_ids=card_ids,
+            starting_from=starting_from,
+            step_size=1,
+            randomize=False,
+            shift_existing=False
+        )
+        done += len(card_ids)
+        progress.update(done, moved)
+    return OpChangesWithCount(count=moved, changes=col.merge_undo_entries(undo_entry))
@@ -0,0 +1,81 @@
+"""
+Runs reorders as background collection operations, one at a time.
+Triggers that arrive while a reorder is running are collapsed into a single
+follow-up run, and bursts of sync triggers are debounced. The reorder modules are imported on the
+first request, keeping them out of Anki's startup.
+"""
+
+from typing import Callable
+from aqt import mw
+from aqt.operations import CollectionOp
+from aqt.qt import QTimer
+from aqt.utils import showInfo, qconnect
+from anki.collection import OpChangesWithCount
+
+from .log import *
+
+SYNC_DEBOUNCE_MS = 2000
+
+class ReorderScheduler:
+    def __init__(self) -> None:
+        self._running = False
+        self._pending_op: Callable | None = None
+        self._next_op: Callable | None = None
+        self._timer: QTimer | None = None
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def request_manual(self) -> None:
+        from . import cards
+        self._request(cards.reorder_cards_with_priority_queue_manual, 0)
+
+    def request_sync_finish(self) -> None:
+        from . import cards
+        self._request(lambda _: cards.reorder_cards_with_priority_queue_sync_finish(), SYNC_DEBOUNCE_MS)
+
+    def request_placement(self) -> None:
+        """Places added cards, unless a reorder that will include them is already waiting to run."""
+        if self._next_op is not None or self._pending_op is not None:
+            return
+        from . import placement
+        self._request(placement.place_added_cards, 0)
+
+    def _request(self, op: Callable, delay_ms: int) -> None:
+        if self._running:
+            log(DEBUG, "Reorder already running, queueing a follow-up run.")
+            self._pending_op = op
+            return
+        self._next_op = op
+        # Restarting the timer folds a burst of triggers into one run
+        self._get_timer().start(delay_ms)
+
+    def _get_timer(self) -> QTimer:
+        if self._timer is None:
+            self._timer = QTimer(mw)
+            self._timer.setSingleShot(True)
+            qconnect(self._timer.timeout, self._run)
+        return self._timer
+
+    def _run(self) -> None:
+        op, self._next_op = self._next_op, None
+        if op is None or self._running or not mw.col:
+            return
+        self._running = True
+        CollectionOp(parent=mw, op=op).success(self._on_success).failure(self._on_failure).run_in_background()
+
+    def _on_success(self, changes: OpChangesWithCount) -> None:
+        log(DEBUG, "Reorder moved %d cards.", changes.count)
+        self._finish()
+
+    def _on_failure(self, err: Exception) -> None:
+        showInfo(f"Error during reordering: {err}")
+        self._finish()
+
+    def _finish(self) -> None:
+        self._running = False
+        op, self._pending_op = self._pending_op, None
+        if op is not None:
+            self._request(op, SYNC_DEBOUNCE_MS)
+
+scheduler = ReorderScheduler()
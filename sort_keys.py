@@ -0,0 +1,116 @@
+"""
+Composite sort keys. Each key is loaded as one column of values over all candidate
+cards, and the cards are ranked by every column at once with a lexicographic sort.
+"""
+
+import ast
+import math
+from array import array
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Sequence
+from anki.collection import Collection
+
+from .fields import load_card_fields, parse_field_value
+from .occurrences import SCORE_REFERENCE, OccurrenceContext, occurrence_sort_expression
+from .state import SortValueCache
+
+# Sort key source ordering cards by when they were added, the card id being its creation time
+ADDED_KEY = "added"
+
+_SCORE_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.UAdd, ast.USub, ast.Constant, ast.Name, ast.Load,
+)
+
+@dataclass(frozen=True)
+class SortKey:
+    source: str
+    descending: bool
+
+def parse_sort_keys(specs: List[str]) -> List[SortKey]:
+    """Parses sort_keys entries, a leading "-" sorting that key in descending order."""
+    keys = []
+    for spec in specs:
+        spec = spec.strip()
+        descending = spec.startswith("-")
+        source = spec[1:].strip() if descending else spec
+        if source:
+            keys.append(SortKey(source, descending))
+    return keys
+
+def _divide(a: float, b: float) -> float:
+    return a / b if b else math.inf
+
+class _SafeDivision(ast.NodeTransformer):
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Div):
+            return ast.copy_location(ast.Call(ast.Name("_divide", ast.Load()), [node.left, node.right], []), node)
+        return node
+
+@lru_cache(maxsize=32)
+def compile_score(source: str) -> tuple[List[str], Callable[..., float]]:
+    """
+    Compiles a score like "{FreqSort} / (1 + {occurrences:A})" into the sources it
+    references and a function computing the score from their values. Only numbers,
+    + - * / and parentheses are allowed, and division by zero gives infinity.
+    """
+    references = list(dict.fromkeys(SCORE_REFERENCE.findall(source)))
+    names = {reference: f"_{i}" for i, reference in enumerate(references)}
+    tree = ast.parse(SCORE_REFERENCE.sub(lambda m: names[m.group(1)], source), mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _SCORE_NODES) or (isinstance(node, ast.Constant) and not isinstance(node.value, (int, float))):
+            raise ValueError(f"Unsupported sort score: {source}")
+        if isinstance(node, ast.Name) and node.id not in names.values():
+            raise ValueError(f"Unknown name in sort score: {source}")
+    body = _SafeDivision().visit(tree).body
+    arguments = ast.arguments(posonlyargs=[], args=[ast.arg(name) for name in names.values()], kwonlyargs=[], kw_defaults=[], defaults=[])
+    function = ast.fix_missing_locations(ast.Expression(ast.Lambda(arguments, body)))
+    return references, eval(compile(function, "<sort score>", "eval"), {"__builtins__": {}, "_divide": _divide})
+
+def load_column(col: Collection, source: str, card_ids: List[int], value_cache: SortValueCache, occurrence_context: OccurrenceContext) -> array:
+    """The values of source for card_ids, aligned with them. Missing values are infinite, missing occurrences 0."""
+    if source == ADDED_KEY:
+        return array("d", card_ids)
+    if SCORE_REFERENCE.search(source):
+        references, score = compile_score(source)
+        columns = [load_column(col, reference, card_ids, value_cache, occurrence_context) for reference in references]
+        values = map(score, *columns) if columns else (score() for _ in card_ids)
+        return array("d", (math.inf if math.isnan(value) else value for value in values))
+    if source == value_cache.sort_field:
+        return array("d", (value for _, value in value_cache.get_card_tuples(card_ids)))
+    occurrence_expression = occurrence_sort_expression(source)
+    if occurrence_expression:
+        values = occurrence_context.card_values(occurrence_expression, card_ids)
+        return array("d", (values[card_id][1] if card_id in values else 0 for card_id in card_ids))
+    fields = load_card_fields(col, card_ids, source)
+    return array("d", (parse_field_value(fields[card_id][1]) if card_id in fields else math.inf for card_id in card_ids))
+
+def lexsort(columns: List[Sequence[float]], descending: List[bool]) -> List[int]:
+    """
+    Row indexes ordered by the first column, ties broken by the next column and so on.
+    Rows equal in every column keep their input order.
+    """
+    order = list(range(len(columns[0]))) if columns else []
+    # Python's sort is stable, also when reversed, so sorting by the last key first gives lexicographic order
+    for column, reverse in zip(reversed(columns), reversed(descending)):
+        order.sort(key=column.__getitem__, reverse=reverse)
+    return order
+
+def rank_cards(col: Collection, card_ids: List[int], sort_keys: List[SortKey], value_cache: SortValueCache, occurrence_context: OccurrenceContext) -> Dict[int, int]:
+    """
+    Dense rank of each card under sort_keys, in ranked order. Cards equal in every key
+    share a rank and keep their order in card_ids, like sorting by a single field does.
+    """
+    columns = [load_column(col, key.source, card_ids, value_cache, occurrence_context) for key in sort_keys]
+    ranks = {}
+    rank = -1
+    previous = None
+    for row in lexsort(columns, [key.descending for key in sort_keys]):
+        values = tuple(column[row] for column in columns)
+        if values != previous:
+            rank += 1
+            previous = values
+        ranks[card_ids[row]] = rank
+    return ranks
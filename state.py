@@ -0,0 +1,268 @@
+"""
+What incremental mode keeps between reorders, and the fingerprint of the last reorder's
+inputs, for skipping reorders that wouldn't change anything. Both are stored in the
+addon's user_files, one file per collection.
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import asdict
+from typing import Any, Dict, Iterable, List, Set, Tuple
+from anki.collection import Collection
+
+from . import metrics
+from .config import AddonConfig, SearchConfig
+from .fields import load_card_fields, parse_field_value
+from .dictionaries import dictionary_version
+from .occurrences import OccurrenceContext, occurrence_sort_expression, referenced_dictionaries
+from .log import *
+
+STATE_DIR = os.path.join(os.path.dirname(__file__), "user_files")
+STATE_FILE_NAME = "priority_reorder_state.json"
+STATE_VERSION = 4
+FINGERPRINT_FILE_NAME = "priority_reorder_fingerprint.json"
+# Past this share of changed cards, running the searches in full is faster than restricting them
+MAX_DIRTY_SHARE = 0.5
+
+class SortValueCache:
+    """
+    Sort values keyed by card id, each remembered with its note id. Cards of notes
+    in stale_note_ids, and cards not seen before, are reloaded from the collection.
+    A sort_field of occurrences:<dictionary or aggregate> sorts by occurrence counts
+    from occurrence_context instead of a note field.
+    """
+
+    def __init__(self, col: Collection, sort_field: str, values: Dict[int, Tuple[int, float]] | None = None, stale_note_ids: Set[int] | None = None, occurrence_context: OccurrenceContext | None = None) -> None:
+        self.col = col
+        self.sort_field = sort_field
+        self.occurrence_context = occurrence_context
+        self.values = values or {}
+        self.stale_note_ids = stale_note_ids or set()
+        self.loaded: Set[int] = set()
+        self.used: Set[int] = set()
+        # Whether a reloaded value differs from the remembered one
+        self.changed = False
+
+    def _needs_load(self, card_id: int) -> bool:
+        if card_id in self.loaded:
+            return False
+        cached = self.values.get(card_id)
+        return cached is None or cached[0] in self.stale_note_ids
+
+    def get_card_tuples(self, card_ids: List[int]) -> List[tuple]:
+        missing = [card_id for card_id in card_ids if self._needs_load(card_id)]
+        if missing:
+            loaded_values = self._load_values(missing)
+            self.changed = self.changed or any(self.values.get(card_id) != value for card_id, value in loaded_values.items())
+            self.values.update(loaded_values)
+            self.loaded.update(missing)
+        self.used.update(card_ids)
+        return [(card_id, self.values[card_id][1] if card_id in self.values else float("inf")) for card_id in card_ids]
+
+    def _load_values(self, card_ids: List[int]) -> Dict[int, Tuple[int, float]]:
+        occurrence_expression = occurrence_sort_expression(self.sort_field)
+        if occurrence_expression and self.occurrence_context:
+            return self.occurrence_context.card_values(occurrence_expression, card_ids)
+        return {
+            card_id: (note_id, parse_field_value(raw_value))
+            for card_id, (note_id, raw_value) in load_card_fields(self.col, card_ids, self.sort_field).items()
+        }
+
+class ReorderState:
+    """
+    The cards each search matched, the sort values and the final order of the last
+    reorder, with what changed since. Cards added, moved or edited since, and the cards
+    of notes edited since, are in dirty_card_ids and searched again. dirty_card_ids is
+    None when every search has to run in full: without usable state, after a day change,
+    which terms like added:3 depend on, or after a deck rename.
+    """
+
+    def __init__(self, col: Collection, state_key: str, settings: list, note_mark: List[int], value_caches: Dict[str, SortValueCache], search_results: Dict[str, List[int]] | None = None, dirty_card_ids: Set[int] | None = None, removed_card_ids: Set[int] | None = None, order: Tuple[List[int], List[int]] | None = None, saved_marks: List[List[int]] | None = None) -> None:
+        self.col = col
+        self.state_key = state_key
+        self.settings = settings
+        self.note_mark = note_mark
+        self.value_caches = value_caches
+        self.search_results = search_results or {}
+        self.dirty_card_ids = dirty_card_ids
+        self.removed_card_ids = removed_card_ids or set()
+        self.order = order
+        self.saved_marks = saved_marks
+
+    @property
+    def unchanged(self) -> bool:
+        """Whether the last order can be reused as it is."""
+        return self.order is not None and self.dirty_card_ids is not None and not self.dirty_card_ids and not self.removed_card_ids
+
+    def previous_search_result(self, search: str, search_config: SearchConfig | None) -> Set[int] | None:
+        card_ids = self.search_results.get(search_result_key(search, search_config))
+        return None if card_ids is None else set(card_ids)
+
+def _state_path(col: Collection, file_name: str = STATE_FILE_NAME) -> str:
+    # Keyed by the collection's path like the occurrence count cache, so profiles and
+    # several collections reordered outside Anki each keep their own
+    digest = hashlib.sha1(os.path.abspath(col.path).encode("utf-8")).hexdigest()[:16]
+    stem, extension = os.path.splitext(file_name)
+    return os.path.join(STATE_DIR, f"{stem}_{digest}{extension}")
+
+def _write_json(path: str, data: Any) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # json.dumps uses the C encoder, which json.dump writing to a file doesn't
+    payload = json.dumps(data, separators=(",", ":"))
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write(payload)
+    os.replace(f"{path}.tmp", path)
+
+def value_cache_key(sort_field: str, search_config: SearchConfig | None) -> str:
+    """Key of the sort values of sort_field, which only depend on the search fields when sorting by occurrences."""
+    if occurrence_sort_expression(sort_field) and search_config:
+        return "\x1f".join([sort_field, search_config.expression_field or "", search_config.expression_reading_field or ""])
+    return sort_field
+
+def search_result_key(search: str, search_config: SearchConfig | None) -> str:
+    if not search_config:
+        return search
+    return "\x1f".join([search, search_config.expression_field or "", search_config.expression_reading_field or ""])
+
+def compute_state_key(col: Collection, config: AddonConfig) -> str:
+    dictionaries = referenced_dictionaries([
+        search
+        for profile in [config] + config.reorder_profiles
+        for search in profile.priority_search + [profile.normal_search, profile.sort_field] + profile.sort_keys
+    ])
+    payload = json.dumps([
+        asdict(config),
+        {dict_name: dictionary_version(dict_name) for dict_name in dictionaries},
+        col.db.scalar("select scm from col"),
+    ], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def collection_settings(col: Collection, config: AddonConfig) -> list:
+    """The deck names when searches use deck:, and the deck options when top_k_days reads them."""
+    searches = [search for profile in [config] + config.reorder_profiles for search in profile.priority_search + [profile.normal_search]]
+    decks = None
+    if any("deck:" in search.lower() for search in searches):
+        metrics.count("db_queries")
+        # Renaming a deck changes which cards its deck: searches match, without changing any card
+        decks = [list(row) for row in col.db.all("select id, name from decks order by id")]
+    # top_k_days reads the new cards/day limit of the deck options
+    reads_deck_configs = any(profile.top_k is None and profile.top_k_days for profile in [config] + config.reorder_profiles)
+    deck_configs = [[conf["id"], conf["mod"]] for conf in col.decks.all_config()] if reads_deck_configs else None
+    return [decks, deck_configs]
+
+def load_reorder_state(col: Collection, config: AddonConfig, sources: Dict[str, Tuple[str, OccurrenceContext | None]], positions: Dict[int, int]) -> ReorderState:
+    """
+    The state of the last reorder, with one sort value cache for each key in sources, which
+    maps it to the sort field and occurrence context the cache loads values with. positions
+    holds the current new cards.
+    """
+    state_key = compute_state_key(col, config)
+    settings = collection_settings(col, config)
+    metrics.count("db_queries")
+    # Taken before any value is loaded, so a note edited while reordering counts as edited next time
+    note_mod, note_usn = col.db.first("select max(mod), max(usn) from notes")
+    note_mark = [note_mod or 0, note_usn or 0]
+    try:
+        with open(_state_path(col), "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = None
+
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION or state.get("state_key") != state_key:
+        log(DEBUG, "No usable incremental state, doing a full rebuild.")
+        return ReorderState(col, state_key, settings, note_mark, {
+            key: SortValueCache(col, sort_field, occurrence_context=occurrence_context)
+            for key, (sort_field, occurrence_context) in sources.items()
+        })
+
+    # Notes pulled in by a sync get a usn above the last one seen whatever their mod time,
+    # and notes edited since the last sync have a usn of -1. Cards use the mark taken after
+    # the last write, which set the mod time and a usn of -1 of every card it moved.
+    metrics.count("db_queries")
+    changed = col.db.all(
+        "select c.id, c.nid from cards c join notes n on c.nid = n.id where c.type = 0"
+        " and (n.mod > ? or n.usn > ? or n.usn = -1 or c.mod > ? or c.usn > ?)",
+        *state["note_mark"], *state["card_mark"],
+    )
+    stale_note_ids = {note_id for _, note_id in changed}
+    previous_card_ids = set(state["card_ids"])
+    dirty_card_ids = {card_id for card_id, _ in changed}
+    dirty_card_ids.update(card_id for card_id in positions if card_id not in previous_card_ids)
+    removed_card_ids = previous_card_ids.difference(positions)
+    caches = {}
+    for key, (sort_field, occurrence_context) in sources.items():
+        card_ids, note_ids, values = state["values"].get(key, ([], [], []))
+        caches[key] = SortValueCache(col, sort_field, dict(zip(card_ids, zip(note_ids, values))), stale_note_ids, occurrence_context)
+
+    if state["today"] != col.sched.today or state["settings"] != settings or len(dirty_card_ids) > len(positions) * MAX_DIRTY_SHARE:
+        dirty_card_ids = None
+    log(DEBUG, "Incremental state loaded: %d changed cards, %d removed.", -1 if dirty_card_ids is None else len(dirty_card_ids), len(removed_card_ids))
+    return ReorderState(
+        col, state_key, settings, note_mark, caches, state["searches"], dirty_card_ids, removed_card_ids,
+        (state["order"], state["deferred"]), [state["note_mark"], state["card_mark"]],
+    )
+
+def save_reorder_state(state: ReorderState, search_results: Dict[Tuple[str, SearchConfig | None], Set[int]], order: List[int], deferred_card_ids: Iterable[int], positions: Dict[int, int]) -> None:
+    """
+    Stores what the next reorder reuses, unless it is what the last reorder stored. Taken
+    after the write, as the cards it moved are only changed since if their mod time is later.
+    """
+    changed = (
+        state.dirty_card_ids is None or state.removed_card_ids
+        or any(cache.changed for cache in state.value_caches.values())
+        or any(card_ids != state.previous_search_result(*key) for key, card_ids in search_results.items())
+    )
+    metrics.count("db_queries")
+    card_mod, card_usn = state.col.db.first("select max(mod), max(usn) from cards")
+    card_mark = [card_mod or 0, card_usn or 0]
+    if not changed and state.saved_marks == [state.note_mark, card_mark]:
+        log(DEBUG, "Incremental state unchanged, not saving it.")
+        return
+    value_columns = {}
+    for key, cache in state.value_caches.items():
+        card_ids = [card_id for card_id in cache.used if card_id in cache.values]
+        value_columns[key] = [card_ids, [cache.values[card_id][0] for card_id in card_ids], [cache.values[card_id][1] for card_id in card_ids]]
+    data = {
+        "version": STATE_VERSION,
+        "state_key": state.state_key,
+        "settings": state.settings,
+        "today": state.col.sched.today,
+        "note_mark": state.note_mark,
+        "card_mark": card_mark,
+        "card_ids": list(positions),
+        "searches": {search_result_key(*key): [card_id for card_id in card_ids if card_id in positions] for key, card_ids in search_results.items()},
+        "values": value_columns,
+        "order": order,
+        "deferred": list(deferred_card_ids),
+    }
+    try:
+        _write_json(_state_path(state.col), data)
+    except OSError as err:
+        log(WARNING, "Could not save incremental state: %s", err)
+def compute_input_fingerprint(col: Collection, config: AddonConfig) -> str:
+    """
+    Hash of everything a reorder reads: the state key, the new cards and notes, the deck
+    names when searches use deck:, and the day, which searches like added:3 depend on.
+    Cards and notes are summed over rather than taking their latest mod time, as sync
+    brings in edits made elsewhere that are older than the latest local one.
+    """
+    metrics.count("db_queries", 2)
+    new_cards = col.db.first("select count(), sum(id), max(id), sum(mod), max(usn) from cards where type = 0")
+    notes = col.db.first("select count(), sum(mod), max(usn) from notes")
+    payload = json.dumps([compute_state_key(col, config), list(new_cards), list(notes), collection_settings(col, config), col.sched.today])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def load_input_fingerprint(col: Collection) -> str | None:
+    try:
+        with open(_state_path(col, FINGERPRINT_FILE_NAME), "r", encoding="utf-8") as f:
+            fingerprint = json.load(f).get("fingerprint")
+    except (OSError, ValueError, AttributeError):
+        return None
+    return fingerprint if isinstance(fingerprint, str) else None
+
+def save_input_fingerprint(col: Collection, fingerprint: str) -> None:
+    try:
+        _write_json(_state_path(col, FINGERPRINT_FILE_NAME), {"fingerprint": fingerprint})
+    except OSError as err:
+        log(WARNING, "Could not save reorder fingerprint: %s", err)